@@ -0,0 +1,90 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+#
+# Copyright: (c) 2020, Lissy Lau <lissy.lau@gmail.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+#
+# bench_log_formatter
+#
+# Compares the cost of resolving %(className)s with inspect.stack() against
+# GerritLogFormatter
+#
+
+import os
+import sys
+import time
+import inspect
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SRC'))
+
+from GerritUtil import *
+
+RECORDS = 20000
+FMT = '[%(asctime)s][%(className)s.%(funcName)s][%(levelname)s]: %(message)s'
+
+
+class InspectLogFormatter(logging.Formatter):
+
+    def format(self, record):
+
+        stack = inspect.stack()
+
+        try:
+            className = stack[9][0].f_locals['self'].__class__.__name__
+        except KeyError:
+            className = 'Global'
+        record.className = className
+
+        return logging.Formatter.format(self, record)
+
+
+class NullHandler(logging.Handler):
+
+    def emit(self, record):
+
+        self.format(record)
+
+        return
+
+
+class Worker():
+
+    def run(self, logger):
+
+        for i in range(0, RECORDS):
+            logger.debug('Gerrit [%d]' % i)
+
+        return
+
+
+def bench(formatter):
+
+    logger = logging.getLogger('GerritBenchLogger')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    handler = NullHandler()
+    handler.setFormatter(formatter)
+    logger.handlers = [handler]
+
+    start = time.time()
+    Worker().run(logger)
+
+    return time.time() - start
+
+
+def main():
+
+    inspect_time = bench(InspectLogFormatter(FMT))
+    frame_time = bench(GerritLogFormatter(FMT))
+
+    print 'inspect.stack():    %8.1f us/record' % (inspect_time * 1e6 / RECORDS)
+    print 'GerritLogFormatter: %8.1f us/record' % (frame_time * 1e6 / RECORDS)
+    print 'Speedup:            %8.1fx' % (inspect_time / frame_time)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
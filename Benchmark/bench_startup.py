@@ -0,0 +1,87 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+#
+# Copyright: (c) 2020, Lissy Lau <lissy.lau@gmail.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+#
+# bench_startup
+#
+# Measures the import time of GerritKit in a fresh interpreter and fails when
+# the console start-up path loads GUI, SSH or git modules
+#
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SRC')
+
+LAZY_MODULES = ['Tkinter', 'ttk', 'tkMessageBox', 'FileDialog', 'tkFileDialog',
+                'paramiko', 'git', 'requests', 'sqlite3']
+
+PROBE = '''
+import sys, time, json
+start = time.time()
+import GerritKit
+elapsed = time.time() - start
+print json.dumps({'time': elapsed,
+                  'loaded': [m for m in %r if m in sys.modules]})
+''' % LAZY_MODULES
+
+EAGER_PROBE = '''
+import time, json
+start = time.time()
+for name in %r:
+    __import__(name)
+print json.dumps({'time': time.time() - start, 'loaded': []})
+''' % LAZY_MODULES
+
+
+def probe(code):
+
+    out = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code],
+                                  cwd = SRC_DIR)
+
+    return json.loads(out.splitlines()[-1])
+
+
+def median(values):
+
+    values = sorted(values)
+
+    return values[len(values) / 2]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'GerritKit start-up benchmark')
+    parser.add_argument('--runs', type = int, default = 5,
+                        help = 'number of fresh interpreters (default: 5)')
+    parser.add_argument('--max-ms', type = float, default = None,
+                        help = 'fail when the median import time exceeds this')
+    args = parser.parse_args()
+
+    results = [probe(PROBE) for i in range(0, args.runs)]
+    import_time = median([r['time'] for r in results]) * 1000
+    eager_time = median([probe(EAGER_PROBE)['time'] for i in range(0, args.runs)]) * 1000
+    loaded = results[0]['loaded']
+
+    print 'import GerritKit:         %8.1f ms' % import_time
+    print 'import of lazy modules:   %8.1f ms' % eager_time
+    print 'Lazy modules loaded:      %s' % (', '.join(loaded) or 'none')
+
+    if loaded:
+        print 'FAIL: console start-up imports %s' % ', '.join(loaded)
+        sys.exit(1)
+    if args.max_ms and import_time > args.max_ms:
+        print 'FAIL: import time exceeds %.1f ms' % args.max_ms
+        sys.exit(1)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+#
+# Copyright: (c) 2020, Lissy Lau <lissy.lau@gmail.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+#
+# GerritAsync
+#
+# This module provides classes for asynchronous gerrit client operations
+#
+
+__version__ = '0.1'
+__author__ = 'Lissy Lau <lissy.lau@gmail.com>'
+
+import sys
+import threading
+import logging
+import collections
+
+from GerritDefaultConfig import *
+from GerritClient import *
+
+reload(sys)
+sys.setdefaultencoding('utf-8')
+logger = logging.getLogger('GerritLogger')
+
+class GerritAsyncResult():
+
+    def __init__(self):
+
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+        return
+
+
+    def ready(self):
+
+        return self.event.is_set()
+
+
+    def wait(self, timeout = None):
+
+        self.event.wait(timeout)
+
+        return self.event.is_set()
+
+
+    def get(self, timeout = None):
+
+        if not self.wait(timeout):
+            raise GerritClientException('Request timed out')
+        if self.error:
+            raise self.error
+
+        return self.result
+
+
+    def add_callback(self, callback):
+
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+
+        callback(self)
+
+        return
+
+
+    def set_result(self, result, error = None):
+
+        with self.lock:
+            self.result = result
+            self.error = error
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error('Callback failed: %s' % e)
+
+        return
+
+
+class AsyncGerritClient():
+
+    def __init__(self, workers = DEFAULT_ASYNC_WORKERS,
+                 server_limit = DEFAULT_ASYNC_SERVER_LIMIT):
+
+        # A fixed set of workers serves all requests, each server gets at
+        # most server_limit of them so that one slow server cannot block others
+        self.pool = multiprocessing_pool.ThreadPool(workers)
+        self.server_limit = server_limit
+        self.lock = threading.Lock()
+        self.pending = dict()
+        self.running = dict()
+
+        return
+
+
+    def get_key(self, server):
+
+        return '%d:%s:%s' % (int(server['Type']), server['URL'], server.get('Port'),)
+
+
+    def get_server_version(self, server):
+
+        return self.submit(server, GerritClient.get_server_version, server)
+
+
+    def get_server_labels(self, server):
+
+        return self.submit(server, GerritClient.get_server_labels, server)
+
+
+    def query(self, server, query, columns):
+
+        return self.submit(server, GerritClient.query, server, query, columns)
+
+
+    def gerrit(self, server, gerrit_id, columns):
+
+        return self.submit(server, GerritClient.gerrit, server, gerrit_id, columns)
+
+
+    def gerrits(self, server, gerrit_ids, columns, batch_size = DETAIL_BATCH_SIZE):
+
+        # SSH batches several changes in one query, REST has one request each
+        if server['Type'] == SRV_TYPE_SSH:
+            batches = [gerrit_ids[i:i + batch_size]
+                       for i in range(0, len(gerrit_ids), batch_size)]
+            results = [self.submit(server, GerritSSHClient.gerrits, server, batch,
+                                   columns, 1, batch_size) for batch in batches]
+        else:
+            results = [self.submit(server, GerritClient.gerrit, server, gerrit_id,
+                                   columns) for gerrit_id in gerrit_ids]
+
+        return gather(results, flatten = server['Type'] == SRV_TYPE_SSH)
+
+
+    def submit(self, server, func, *args):
+
+        result = GerritAsyncResult()
+        key = self.get_key(server)
+
+        with self.lock:
+            self.pending.setdefault(key, collections.deque()).append((result, func, args))
+            self._dispatch(key)
+
+        return result
+
+
+    def close(self):
+
+        self.pool.close()
+        self.pool.join()
+
+        return
+
+
+    def _dispatch(self, key):
+
+        pending = self.pending[key]
+        while pending and self.running.get(key, 0) < self.server_limit:
+            result, func, args = pending.popleft()
+            self.running[key] = self.running.get(key, 0) + 1
+            self.pool.apply_async(self._run, (key, result, func, args))
+        if not pending:
+            del self.pending[key]
+
+        return
+
+
+    def _run(self, key, result, func, args):
+
+        value = None
+        error = None
+
+        try:
+            value = func(*args)
+        except Exception as e:
+            logger.error('Request %s failed: %s' % (func.__name__, e,))
+            error = e
+
+        with self.lock:
+            self.running[key] = self.running[key] - 1
+            if self.pending.has_key(key):
+                self._dispatch(key)
+
+        result.set_result(value, error)
+
+        return
+
+
+def gather(results, flatten = False):
+
+    gathered = GerritAsyncResult()
+    state = {'Count': len(results)}
+    lock = threading.Lock()
+
+    def done(result):
+        with lock:
+            state['Count'] = state['Count'] - 1
+            if state['Count'] > 0:
+                return
+        # Values are in the order of results, the first error wins
+        values = []
+        for item in results:
+            if item.error:
+                gathered.set_result(None, item.error)
+                return
+            if flatten:
+                values.extend(item.result)
+            else:
+                values.append(item.result)
+        gathered.set_result(values)
+
+    if not results:
+        gathered.set_result([])
+    for result in results:
+        result.add_callback(done)
+
+    return gathered
@@ -18,28 +18,51 @@ import os
 import shutil
 import stat
 import errno
+import re
+import socket
+import calendar
 import ConfigParser
+import StringIO
 import sys
 import time
-import git
-import requests
-from requests.auth import HTTPBasicAuth, HTTPDigestAuth
-from requests.cookies import RequestsCookieJar
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-from paramiko import AutoAddPolicy, SSHClient, SSHConfig, ProxyCommand
+import threading
+import tempfile
 import logging
+import Queue
 
 from GerritDefaultConfig import *
+from GerritUtil import LazyModule, GerritFileLock
 
 reload(sys)
 sys.setdefaultencoding('utf-8')
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 logger = logging.getLogger('GerritLogger')
 
+git = LazyModule('git')
+paramiko = LazyModule('paramiko')
+requests = LazyModule('requests')
+multiprocessing_pool = LazyModule('multiprocessing.pool')
+
 GERRIT_REST_HDR = ")]}'\n"
 GERRIT_AUTH_PREFIX = 'a/'
+GERRIT_CONFIG_REF = 'refs/meta/config'
+GERRIT_CONFIG_REFSPEC = '+%s:%s' % (GERRIT_CONFIG_REF, GERRIT_CONFIG_REF,)
 
 MIN_GERRIT_VERSION = '2.7'
+LATEST_GERRIT_VERSION = '3.1'
+
+FEDERATED_SERVER_COLUMN = 'Server'
+FEDERATED_EVENT_ROW = 0
+FEDERATED_EVENT_DONE = 1
+
+# Hidden columns which come with Owner, they let the local store match owner
+# filters given as username or email
+OWNER_USERNAME_COLUMN = 'Owner-Username'
+OWNER_EMAIL_COLUMN = 'Owner-Email'
+
+GERRIT_EVENT_TYPES = ('patchset-created', 'comment-added',
+                      'change-merged', 'change-abandoned')
+
+GERRIT_SSH_DETAIL_OPTIONS = '--current-patch-set --submit-records --format=JSON --commit-message --patch-sets --dependencies --files --crs --task--applicable'
 
 SRV_TYPE_UNKNOWN = 0
 SRV_TYPE_SSH = 1
@@ -113,6 +136,526 @@ def on_path_error(func, path, exc_info):
     else:
         raise
 
+def format_timestamp(timestamp):
+
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def get_rest_current_revision(jsons):
+
+    return jsons['revisions'][jsons['current_revision']]
+
+
+def get_rest_change_size(jsons, key, file_key):
+
+    if jsons.has_key(key):
+        return jsons[key]
+    if not jsons.has_key('revisions'):
+        return None
+
+    lines = 0
+
+    for file_info in get_rest_current_revision(jsons)['files'].itervalues():
+        lines = lines + file_info.get(file_key, 0)
+
+    return lines
+
+
+SSH_COLUMN_EXTRACTORS = {
+    'ID':         lambda jsons, labels: jsons['number'],
+    'Subject':    lambda jsons, labels: jsons['subject'],
+    'Owner':      lambda jsons, labels: jsons['owner']['name'],
+    'Owner-Username': lambda jsons, labels: jsons['owner'].get('username'),
+    'Owner-Email':    lambda jsons, labels: jsons['owner'].get('email'),
+    'Author':     lambda jsons, labels: jsons['currentPatchSet']['author']['name'],
+    'Committer':  lambda jsons, labels: jsons['currentPatchSet']['uploader']['name'],
+    'Status':     lambda jsons, labels: jsons['status'],
+    'Project':    lambda jsons, labels: jsons['project'],
+    'Branch':     lambda jsons, labels: jsons['branch'],
+    'Created-On': lambda jsons, labels: format_timestamp(jsons['createdOn']),
+    'Updated-On': lambda jsons, labels: format_timestamp(jsons['lastUpdated']),
+    'Topic':      lambda jsons, labels: jsons.get('topic'),
+    'Insertions': lambda jsons, labels: jsons['currentPatchSet']['sizeInsertions'],
+    'Deletions':  lambda jsons, labels: jsons['currentPatchSet']['sizeDeletions']
+}
+
+REST_COLUMN_EXTRACTORS = {
+    'ID':         lambda jsons, labels: jsons['_number'],
+    'Subject':    lambda jsons, labels: jsons['subject'],
+    'Owner':      lambda jsons, labels: jsons['owner']['name'],
+    'Owner-Username': lambda jsons, labels: jsons['owner'].get('username'),
+    'Owner-Email':    lambda jsons, labels: jsons['owner'].get('email'),
+    'Author':     lambda jsons, labels: get_rest_current_revision(jsons)['commit']['author']['name'],
+    'Committer':  lambda jsons, labels: get_rest_current_revision(jsons)['commit']['committer']['name'],
+    'Status':     lambda jsons, labels: jsons['status'],
+    'Project':    lambda jsons, labels: jsons['project'],
+    'Branch':     lambda jsons, labels: jsons['branch'],
+    'Created-On': lambda jsons, labels: jsons['created'],
+    'Updated-On': lambda jsons, labels: jsons['updated'],
+    'Topic':      lambda jsons, labels: jsons.get('topic'),
+    'Insertions': lambda jsons, labels: get_rest_change_size(jsons, 'insertions', 'lines_inserted'),
+    'Deletions':  lambda jsons, labels: get_rest_change_size(jsons, 'deletions', 'lines_deleted')
+}
+
+REST_COLUMN_OPTIONS = {
+    'Owner':      ('DETAILED_ACCOUNTS',),
+    'Author':     ('CURRENT_REVISION', 'CURRENT_COMMIT'),
+    'Committer':  ('CURRENT_REVISION', 'CURRENT_COMMIT')
+}
+
+# Servers before 2.10 do not report insertions/deletions in ChangeInfo
+REST_LEGACY_SIZE_OPTIONS = ('CURRENT_REVISION', 'CURRENT_FILES')
+
+
+def compile_columns(columns, column_extractors):
+
+    extractors = []
+    has_labels = False
+
+    # Every column which is not a fixed field is a label
+    for col in columns:
+        if column_extractors.has_key(col):
+            extractors.append((col, column_extractors[col]))
+        else:
+            extractors.append((col, lambda jsons, labels, label = col: labels.get(label)))
+            has_labels = True
+
+    if 'Owner' in columns:
+        for col in (OWNER_USERNAME_COLUMN, OWNER_EMAIL_COLUMN):
+            if col not in columns:
+                extractors.append((col, column_extractors[col]))
+
+    return tuple(extractors), has_labels
+
+
+class GerritSSHConnectionPool():
+
+    def __init__(self, max_size = DEFAULT_SSH_POOL_SIZE,
+                 idle_timeout = DEFAULT_SSH_IDLE_TIMEOUT):
+
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.connections = dict()
+
+        return
+
+
+    def configure(self, max_size = None, idle_timeout = None):
+
+        if max_size:
+            self.max_size = max_size
+        if idle_timeout:
+            self.idle_timeout = idle_timeout
+
+        return
+
+
+    def get_key(self, server):
+
+        if server.has_key('Username'):
+            username = server['Username']
+        else:
+            username = None
+
+        return (server['URL'], int(server['Port']), username)
+
+
+    def acquire(self, server):
+
+        key = self.get_key(server)
+        stale = []
+        candidate = None
+
+        with self.lock:
+            stale.extend(self._evict_idle())
+            conn = self.connections.get(key)
+            if conn and conn['Users'] > 0:
+                # A transport in use is shared without being probed
+                if self._is_active(conn):
+                    conn['Users'] = conn['Users'] + 1
+                    conn['LastUsed'] = time.time()
+                else:
+                    logger.debug('Drop dead SSH connection to %s:%d' % key[:2])
+                    del self.connections[key]
+                    conn = None
+            elif conn:
+                # An idle connection is taken out and probed after the lock
+                # is released, the probe goes over the network
+                del self.connections[key]
+                candidate = conn
+                conn = None
+
+        self._close(stale)
+        stale = []
+
+        if conn:
+            logger.debug('Reuse SSH connection to %s:%d' % key[:2])
+            return conn['Client']
+
+        if candidate and self._is_alive(candidate):
+            logger.debug('Reuse SSH connection to %s:%d' % key[:2])
+            client = candidate['Client']
+        else:
+            if candidate:
+                logger.debug('Drop dead SSH connection to %s:%d' % key[:2])
+                self._close([candidate])
+            client = self._connect(server)
+
+        with self.lock:
+            if len(self.connections) >= self.max_size:
+                stale.extend(self._evict_lru())
+            conn = self.connections.get(key)
+            if conn:
+                # Another thread connected in the meantime, keep its transport
+                stale.append({'Client': client})
+                conn['Users'] = conn['Users'] + 1
+                conn['LastUsed'] = time.time()
+                client = conn['Client']
+            else:
+                self.connections[key] = {'Client': client, 'Users': 1,
+                                         'LastUsed': time.time()}
+
+        self._close(stale)
+
+        return client
+
+
+    def release(self, server, client):
+
+        key = self.get_key(server)
+        stale = []
+
+        with self.lock:
+            conn = self.connections.get(key)
+            if conn and conn['Client'] is client:
+                conn['Users'] = conn['Users'] - 1
+                conn['LastUsed'] = time.time()
+                if conn['Users'] == 0 and len(self.connections) > self.max_size:
+                    del self.connections[key]
+                    stale.append(conn)
+            else:
+                # Evicted while in use
+                stale.append({'Client': client})
+
+        self._close(stale)
+
+        return
+
+
+    def discard(self, server, client):
+
+        key = self.get_key(server)
+
+        with self.lock:
+            conn = self.connections.get(key)
+            if conn and conn['Client'] is client:
+                del self.connections[key]
+
+        self._close([{'Client': client}])
+
+        return
+
+
+    def close_all(self):
+
+        with self.lock:
+            stale = self.connections.values()
+            self.connections = dict()
+
+        self._close(stale)
+
+        return
+
+
+    def _connect(self, server):
+
+        if server.has_key('Username'):
+            username = server['Username']
+            password = server['Password']
+        else:
+            username = None
+            password = None
+
+        logger.debug('Open SSH connection to %s:%s' % (server['URL'], server['Port'],))
+
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.connect(hostname = server['URL'], port = int(server['Port']),
+                       username = username, password = password)
+        client.get_transport().set_keepalive(DEFAULT_SSH_KEEPALIVE_INTERVAL)
+
+        return client
+
+
+    def _is_active(self, conn):
+
+        transport = conn['Client'].get_transport()
+
+        return bool(transport and transport.is_active())
+
+
+    def _is_alive(self, conn):
+
+        if not self._is_active(conn):
+            return False
+        try:
+            conn['Client'].get_transport().send_ignore()
+        except Exception:
+            return False
+
+        return True
+
+
+    def _evict_idle(self):
+
+        stale = []
+        now = time.time()
+
+        for key in self.connections.keys():
+            conn = self.connections[key]
+            if conn['Users'] == 0 and now - conn['LastUsed'] > self.idle_timeout:
+                logger.debug('Evict idle SSH connection to %s:%d' % key[:2])
+                del self.connections[key]
+                stale.append(conn)
+
+        return stale
+
+
+    def _evict_lru(self):
+
+        stale = []
+        idle = [(conn['LastUsed'], key) for key, conn in self.connections.items()
+                if conn['Users'] == 0]
+        idle.sort()
+
+        while idle and len(self.connections) >= self.max_size:
+            last_used, key = idle.pop(0)
+            logger.debug('Evict SSH connection to %s:%d' % key[:2])
+            stale.append(self.connections.pop(key))
+
+        return stale
+
+
+    def _close(self, conns):
+
+        for conn in conns:
+            try:
+                conn['Client'].close()
+            except Exception:
+                pass
+
+        return
+
+
+ssh_pool = GerritSSHConnectionPool()
+
+
+class GerritHTTPSessionPool():
+
+    def __init__(self, pool_connections = DEFAULT_HTTP_POOL_CONNECTIONS,
+                 pool_maxsize = DEFAULT_HTTP_POOL_MAXSIZE):
+
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.lock = threading.Lock()
+        self.sessions = dict()
+
+        return
+
+
+    def configure(self, pool_connections = None, pool_maxsize = None):
+
+        if pool_connections:
+            self.pool_connections = pool_connections
+        if pool_maxsize:
+            self.pool_maxsize = pool_maxsize
+
+        # Sessions are re-created with the new adapter sizes on next use
+        self.close_all()
+
+        return
+
+
+    def get_key(self, server, anonymous = False):
+
+        key = (server['URL'], server.get('Proxy'))
+        if not anonymous and server.get('AuthType', AUTH_TYPE_NONE) != AUTH_TYPE_NONE:
+            key = key + (server['AuthType'], server['Username'], server['Password'])
+
+        return key
+
+
+    def get(self, server, anonymous = False):
+
+        key = self.get_key(server, anonymous)
+
+        with self.lock:
+            session = self.sessions.get(key)
+            if not session:
+                session = self._create(server, anonymous)
+                self.sessions[key] = session
+
+        return session
+
+
+    def close_all(self):
+
+        with self.lock:
+            sessions = self.sessions.values()
+            self.sessions = dict()
+
+        for session in sessions:
+            session.close()
+
+        return
+
+
+    def _create(self, server, anonymous):
+
+        logger.debug('Open HTTP session to %s' % server['URL'])
+
+        disable_insecure_request_warnings()
+
+        session = requests.Session()
+        session.verify = False
+        session.headers.update({'Content-Type': 'application/json'})
+        adapter = requests.adapters.HTTPAdapter(pool_connections = self.pool_connections,
+                              pool_maxsize = self.pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        if server.has_key('Proxy'):
+            session.proxies = {'http': server['Proxy'], 'https': server['Proxy']}
+
+        if not anonymous and server.has_key('AuthType'):
+            if server['AuthType'] == AUTH_TYPE_HTTP_BASIC:
+                session.auth = requests.auth.HTTPBasicAuth(server['Username'], server['Password'])
+            elif server['AuthType'] == AUTH_TYPE_HTTP_DIGEST:
+                session.auth = requests.auth.HTTPDigestAuth(server['Username'], server['Password'])
+            elif server['AuthType'] == AUTH_TYPE_HTTP_COOKIE:
+                session.cookies.set(server['Username'], server['Password'],
+                                    domain = server['URL'], path = '/')
+
+        return session
+
+
+http_sessions = GerritHTTPSessionPool()
+
+
+class GerritServerCache():
+
+    def __init__(self, cache_file = SERVER_CACHE_FILE,
+                 ttl = DEFAULT_SERVER_CACHE_TTL):
+
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = None
+
+        return
+
+
+    def get_key(self, server):
+
+        # SSH servers on another port may be different servers
+        if int(server['Type']) == SRV_TYPE_SSH:
+            return '%d:%s:%s' % (int(server['Type']), server['URL'], server.get('Port', ''),)
+
+        return '%d:%s' % (int(server['Type']), server['URL'])
+
+
+    def get(self, server, name, stale = False):
+
+        with self.lock:
+            self._load()
+            entry = self.data.get(self.get_key(server), dict())
+            item = entry.get(name)
+
+        if item and not stale and time.time() - item['Time'] > self.ttl:
+            return None
+
+        return item
+
+
+    def set(self, server, name, value, etag = None, last_modified = None):
+
+        item = {'Value': value, 'Time': time.time()}
+        if etag:
+            item['ETag'] = etag
+        if last_modified:
+            item['LastModified'] = last_modified
+
+        with self.lock:
+            self._load()
+            self.data.setdefault(self.get_key(server), dict())[name] = item
+            self._save()
+
+        return
+
+
+    def touch(self, server, name):
+
+        with self.lock:
+            self._load()
+            entry = self.data.get(self.get_key(server), dict())
+            if entry.has_key(name):
+                entry[name]['Time'] = time.time()
+                self._save()
+
+        return
+
+
+    def invalidate(self, server):
+
+        with self.lock:
+            self._load()
+            if self.data.pop(self.get_key(server), None) is not None:
+                self._save()
+
+        return
+
+
+    def _load(self):
+
+        if self.data is not None:
+            return
+
+        try:
+            with open(self.cache_file, 'r') as f:
+                self.data = json.load(f)
+        except (IOError, ValueError):
+            self.data = dict()
+
+        return
+
+
+    def _save(self):
+
+        try:
+            os.makedirs(os.path.dirname(self.cache_file))
+        except OSError:
+            pass
+
+        tmp_file = '%s.%d.tmp' % (self.cache_file, os.getpid(),)
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self.data, f)
+            if sys.platform == 'win32' and os.path.exists(self.cache_file):
+                os.remove(self.cache_file)
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError) as e:
+            logger.debug('Failed to save server cache: %s' % e)
+
+        return
+
+
+server_cache = GerritServerCache()
+
+config_mirror_locks = dict()
+config_mirror_locks_lock = threading.Lock()
+
+
 class GerritSSHClient():
 
     @classmethod
@@ -130,20 +673,17 @@ class GerritSSHClient():
         res_str = ''
         port = -1
 
-        if server.has_key('Proxy'):
-            proxies = {'http': server['Proxy'], 'https': server['Proxy']}
-        else:
-            proxies = None
+        session = http_sessions.get(server, anonymous = True)
 
         cmd = 'https://%s/ssh_info' % server['URL']
 
-        ret_code, res = http_get(cmd, proxies = proxies)
+        ret_code, res = http_get(cmd, session = session)
         if ret_code == HTTP_OK:
             ret_code = 0
         elif ret_code == HTTP_NOT_FOUND:
             logger.debug('Retry with HTTP')
             cmd = 'http://%s/ssh_info' % server['URL']
-            ret_code, res = http_get(cmd, proxies = proxies)
+            ret_code, res = http_get(cmd, session = session)
             if ret_code == HTTP_OK:
                 ret_code = 0
             else:
@@ -169,6 +709,16 @@ class GerritSSHClient():
         full_version = MIN_GERRIT_VERSION
         port = -1
 
+        # The entry is kept under the port the server was probed with
+        cache_server = dict(server)
+        item = server_cache.get(cache_server, 'ssh_version')
+        if item:
+            server['Port'] = item['Value']['Port']
+            full_version = item['Value']['Version']
+            res_str = 'Gerrit Server: ssh://%s:%s (cached)\n' % (server['URL'], server['Port'],)
+            res_str = res_str + 'Gerrit Version: %s (cached)\n' % full_version
+            return ret_code, res_str, full_version
+
         ret_code, res_str, port = cls.get_server_port(server)
         if ret_code != 0:
             return ret_code, res_str, full_version
@@ -179,6 +729,8 @@ class GerritSSHClient():
         full_version = res[0].split()[2]
         res_str = res_str + 'Gerrit Version: %s\n' % full_version
 
+        server_cache.set(cache_server, 'ssh_version', {'Port': port, 'Version': full_version})
+
         return ret_code, res_str, full_version
 
 
@@ -190,10 +742,12 @@ class GerritSSHClient():
         res_str = ''
         port = -1
 
-        try:
-            shutil.rmtree(TMP_DIR, ignore_errors = False, onerror = on_path_error)
-        except OSError:
-            pass
+        item = server_cache.get(server, 'git_labels')
+        if item:
+            for label_name in item['Value']:
+                labels.append(label_name)
+                res_str = res_str + 'Label: %s (cached)\n' % label_name
+            return ret_code, res_str, labels
 
         if server['Type'] == SRV_TYPE_SSH:
             port = server['Port']
@@ -203,8 +757,6 @@ class GerritSSHClient():
                 return ret_code, res_str, labels
 
         if server.has_key('Proxy'):
-            cmd = 'git config --global http.proxy %s' % server['Proxy']
-            git.Git().execute(cmd.split())
             all_project_path = 'https://%s/All-Projects' % server['URL']
         else:
             if server.has_key('Username'):
@@ -212,16 +764,39 @@ class GerritSSHClient():
             else:
                 all_project_path = 'ssh://%s:%s/All-Projects' % (server['URL'], port,)
 
-        git.Repo.clone_from(all_project_path, TMP_DIR)
-
-        if server.has_key('Proxy'):
-            cmd = 'git config --global --unset http.proxy'
-            git.Git().execute(cmd.split())
+        try:
+            if DEFAULT_KEEP_CONFIG_MIRROR:
+                # Other processes may fetch into the same mirror at the same time
+                mirror_dir = get_config_mirror_dir(server)
+                try:
+                    os.makedirs(CONFIG_MIRROR_DIR)
+                except OSError:
+                    pass
+                with get_config_mirror_lock(mirror_dir):
+                    with GerritFileLock(mirror_dir + '.lock', CONFIG_MIRROR_LOCK_TIMEOUT):
+                        project_config = cls.fetch_project_config(server, all_project_path,
+                                                                  mirror_dir)
+            else:
+                try:
+                    os.makedirs(TMP_DIR)
+                except OSError:
+                    pass
+                mirror_dir = tempfile.mkdtemp(dir = TMP_DIR)
+                try:
+                    project_config = cls.fetch_project_config(server, all_project_path,
+                                                              mirror_dir)
+                finally:
+                    try:
+                        shutil.rmtree(mirror_dir, ignore_errors = False, onerror = on_path_error)
+                    except:
+                        pass
+        except (git.GitCommandError, IOError, OSError) as e:
+            logger.error('Failed to fetch project.config of %s: %s' % (server['URL'], e,))
+            return 255, res_str + 'Failed to fetch project.config\n', labels
 
         config = ConfigParser.ConfigParser()
-        project_config_file = os.path.join(TMP_DIR, 'project.config')
         try:
-            config.read(project_config_file)
+            config.readfp(StringIO.StringIO(project_config))
         except ConfigParser.ParsingError:
             pass
         sessions = config.sections()
@@ -232,14 +807,34 @@ class GerritSSHClient():
                 labels.append(label_name)
                 res_str = res_str + 'Label: %s\n' % label_name
 
-        try:
-            shutil.rmtree(TMP_DIR, ignore_errors = False, onerror = on_path_error)
-        except:
-            pass
+        server_cache.set(server, 'git_labels', labels)
 
         return ret_code, res_str, labels
 
 
+    @classmethod
+    def fetch_project_config(cls, server, all_project_path, mirror_dir):
+
+        # Only refs/meta/config is fetched, project.config is read from the
+        # fetched tree without a checkout
+        repo = git.Repo.init(mirror_dir, bare = True)
+
+        # The proxy is passed per command, the global git config is untouched
+        if server.has_key('Proxy'):
+            git_options = {'c': 'http.proxy=%s' % server['Proxy']}
+        else:
+            git_options = dict()
+
+        try:
+            repo.git(**git_options).fetch(all_project_path, GERRIT_CONFIG_REFSPEC,
+                                          depth = 1)
+        except git.GitCommandError:
+            logger.debug('Shallow fetch failed, retry with full fetch')
+            repo.git(**git_options).fetch(all_project_path, GERRIT_CONFIG_REFSPEC)
+
+        return repo.git.show('%s:project.config' % GERRIT_CONFIG_REF)
+
+
     @classmethod
     def get_server_labels(cls, server):
 
@@ -247,22 +842,74 @@ class GerritSSHClient():
 
 
     @classmethod
-    def query(cls, server, query, columns):
+    def query(cls, server, query, columns, limit = None):
 
-        gerrits = []
+        return list(cls.iter_query(server, query, columns, limit = limit))
 
-        lines = cls.run_gerrit_cmd(server, 'query %s --current-patch-set --submit-records --format=JSON' % query)
-        jsons = [json.loads(line) for line in lines if line]
-        jsons.pop()
 
-        for gerrit_json in jsons:
-            gerrit = dict()
-            cls._parse_gerrit(gerrit, gerrit_json, columns)
-            gerrits.append(gerrit)
+    @classmethod
+    def iter_query(cls, server, query, columns, limit = None,
+                   page_size = DEFAULT_QUERY_PAGE_SIZE):
+
+        major_version, minor_version = get_server_version_number(server)
+        # --start is available since 2.9, older servers page with sortKey
+        use_sortkey = major_version == 2 and minor_version < 9
+
+        parser = cls.compile_columns(columns)
+        start = 0
+        count = 0
+        sortkey = None
+
+        while True:
+            if limit:
+                page_size = min(page_size, limit - count)
+            if use_sortkey and sortkey:
+                paging = ' resume_sortkey:%s' % sortkey
+            elif start > 0:
+                paging = ' --start %d' % start
+            else:
+                paging = ''
+
+            cmd = ('gerrit query %s limit:%d%s --current-patch-set --submit-records --format=JSON'
+                   % (query, page_size, paging,))
+
+            row_count = 0
+            more_changes = None
+            lines = iter_ssh_cmd(server, cmd)
+            for line in lines:
+                if not line:
+                    continue
+                gerrit_json = json.loads(line)
+                if gerrit_json.has_key('type'):
+                    if gerrit_json['type'] == 'stats':
+                        row_count = gerrit_json.get('rowCount', 0)
+                        more_changes = gerrit_json.get('moreChanges')
+                    elif gerrit_json['type'] == 'error':
+                        logger.error('Query error: %s' % gerrit_json.get('message'))
+                    continue
+                sortkey = gerrit_json.get('sortKey')
+                gerrit = dict()
+                cls._parse_gerrit(gerrit, gerrit_json, parser)
+                count = count + 1
+                yield gerrit
+                if limit and count >= limit:
+                    lines.close()
+                    return
+
+            # Servers without moreChanges return a full page while there is more
+            if more_changes is None:
+                more_changes = row_count >= page_size
+            if not more_changes or row_count == 0:
+                break
+            if limit and count >= limit:
+                break
+            if use_sortkey and not sortkey:
+                break
+            start = start + row_count
 
         logger.debug('DONE')
 
-        return gerrits
+        return
 
 
     @classmethod
@@ -270,9 +917,9 @@ class GerritSSHClient():
 
         gerrit = dict()
 
-        lines = cls.run_gerrit_cmd(server, 'query --current-patch-set --submit-records --format=JSON --commit-message --patch-sets --dependencies --files --crs --task--applicable %s' % gerrit_id)
+        lines = cls.run_gerrit_cmd(server, 'query %s %s' % (GERRIT_SSH_DETAIL_OPTIONS, gerrit_id,))
         jsons = [json.loads(line) for line in lines if line]
-        cls._parse_gerrit(gerrit, jsons[0], columns)
+        cls._parse_gerrit(gerrit, jsons[0], cls.compile_columns(columns))
 
         logger.debug('DONE')
 
@@ -280,42 +927,91 @@ class GerritSSHClient():
 
 
     @classmethod
-    def _parse_gerrit(cls, gerrit, jsons, columns):
+    def gerrits(cls, server, gerrit_ids, columns, workers = DEFAULT_DETAIL_WORKERS,
+                batch_size = DETAIL_BATCH_SIZE):
 
-        for col in columns:
-            if col == 'ID':
-                gerrit[col] = jsons["number"]
-            elif col == 'Subject':
-                gerrit[col] = jsons['subject']
-            elif col == 'Owner':
-                gerrit[col] = jsons['owner']['name']
-            elif col == 'Author':
-                gerrit[col] = jsons['currentPatchSet']['author']['name']
-            elif col == 'Committer':
-                gerrit[col] = jsons['currentPatchSet']['uploader']['name']
-            elif col == 'Status':
-                gerrit[col] = jsons['status']
-            elif col == 'Project':
-                gerrit[col] = jsons['project']
-            elif col == 'Branch':
-                gerrit[col] = jsons['branch']
-            elif col == 'Created-On':
-                timeArray = time.localtime(jsons['createdOn'])
-                gerrit[col] = time.strftime('%Y-%m-%d %H:%M:%S', timeArray)
-            elif col == 'Updated-On':
-                timeArray = time.localtime(jsons['lastUpdated'])
-                gerrit[col] = time.strftime("%Y-%m-%d %H:%M:%S", timeArray)
-            elif col == 'Topic' and jsons.has_key('topic'):
-                gerrit[col] = jsons['topic']
-            elif col == 'Insertions':
-                gerrit[col] = jsons['currentPatchSet']['sizeInsertions']
-            elif col == 'Deletions':
-                gerrit[col] = jsons['currentPatchSet']['sizeDeletions']
-            else:
-                labels = jsons['submitRecords'][0]['labels']
-                for label in labels:
-                    if label['label'] == col:
-                        gerrit[col] = label['status']
+        parser = cls.compile_columns(columns)
+        batches = [gerrit_ids[i:i + batch_size]
+                   for i in range(0, len(gerrit_ids), batch_size)]
+
+        # Every batch is one query with several change: terms, batches run
+        # concurrently on channels of the pooled connection
+        def run(batch):
+            cmd = 'query %s %s' % (GERRIT_SSH_DETAIL_OPTIONS, get_changes_filter(batch),)
+            return [json.loads(line) for line in cls.run_gerrit_cmd(server, cmd) if line]
+
+        gerrits = dict()
+        for jsons in pool_map(run, batches, workers):
+            for gerrit_json in jsons:
+                if gerrit_json.get('type') == 'stats':
+                    continue
+                gerrit = dict()
+                cls._parse_gerrit(gerrit, gerrit_json, parser)
+                gerrits[str(gerrit_json['number'])] = gerrit
+                gerrits[gerrit_json['id']] = gerrit
+
+        logger.debug('DONE')
+
+        return [gerrits.get(str(gerrit_id), dict()) for gerrit_id in gerrit_ids]
+
+
+    @classmethod
+    def iter_events(cls, server):
+
+        cmd = 'gerrit stream-events'
+        major_version, minor_version = get_server_version_number(server)
+        if major_version > 2 or minor_version >= 11:
+            for event_type in GERRIT_EVENT_TYPES:
+                cmd = '%s -s %s' % (cmd, event_type)
+
+        # None is passed through as a heartbeat when the stream is idle
+        for line in iter_ssh_stream(server, cmd):
+            if line is None:
+                yield None
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                logger.debug('Invalid event: %s' % line)
+                continue
+            if event.get('type') in GERRIT_EVENT_TYPES:
+                yield event
+
+        return
+
+
+    @classmethod
+    def compile_columns(cls, columns):
+
+        return compile_columns(columns, SSH_COLUMN_EXTRACTORS)
+
+
+    @classmethod
+    def _parse_labels(cls, jsons):
+
+        labels = dict()
+
+        if jsons.has_key('submitRecords'):
+            for label in jsons['submitRecords'][0].get('labels', []):
+                labels[label['label']] = label['status']
+
+        return labels
+
+
+    @classmethod
+    def _parse_gerrit(cls, gerrit, jsons, parser):
+
+        extractors, has_labels = parser
+
+        if has_labels:
+            labels = cls._parse_labels(jsons)
+        else:
+            labels = None
+
+        for col, extract in extractors:
+            value = extract(jsons, labels)
+            if value is not None:
+                gerrit[col] = value
 
         return
 
@@ -329,7 +1025,7 @@ class GerritRESTClient():
         res_str = ''
         full_version = MIN_GERRIT_VERSION
 
-        ret_code, full_version = cls.get(server, 'config/server/version')
+        ret_code, full_version = cls.get_cached(server, 'config/server/version')
         if ret_code == HTTP_OK:
             full_version = full_version.strip('"')
             res_str = 'Gerrit Version: %s\n' % full_version
@@ -349,7 +1045,7 @@ class GerritRESTClient():
         res_str = ''
         labels = []
 
-        ret_code, lines = cls.get(server, 'projects/All-Projects')
+        ret_code, lines = cls.get_cached(server, 'projects/All-Projects')
         if ret_code == HTTP_OK:
             jsons = json.loads(lines)
             if jsons.has_key('labels'):
@@ -360,7 +1056,7 @@ class GerritRESTClient():
             ret_code = 0
         # Hack for gerrit-review.googlesource.com for which All-Projects is not present
         elif ret_code == HTTP_NOT_FOUND:
-            ret_code, lines = cls.get(server, 'projects/gerrit')
+            ret_code, lines = cls.get_cached(server, 'projects/gerrit')
             if ret_code == HTTP_OK:
                 jsons = json.loads(lines)
                 if jsons.has_key('labels'):
@@ -374,24 +1070,52 @@ class GerritRESTClient():
 
 
     @classmethod
-    def query(cls, server, query, columns):
+    def query(cls, server, query, columns, limit = None):
 
-        gerrits = []
-        params = 'q=%s&o=LABELS&o=DETAILED_ACCOUNTS&o=CURRENT_REVISION&o=CURRENT_COMMIT&o=CURRENT_FILES' % query
+        return list(cls.iter_query(server, query, columns, limit = limit))
 
-        logger.debug('Query: %s' % params)
 
-        ret_code, lines = cls.get(server, 'changes/', params = params)
-        if ret_code == HTTP_OK:
+    @classmethod
+    def iter_query(cls, server, query, columns, limit = None,
+                   page_size = DEFAULT_QUERY_PAGE_SIZE):
+
+        parser = cls.compile_columns(columns)
+        options = ''.join(['&o=%s' % option for option in cls.get_query_options(server, columns)])
+        start = 0
+        count = 0
+
+        while True:
+            if limit:
+                page_size = min(page_size, limit - count)
+            params = 'q=%s&n=%d&S=%d%s' % (query, page_size, start, options,)
+
+            logger.debug('Query: %s' % params)
+
+            ret_code, lines = cls.get(server, 'changes/', params = params)
+            if ret_code != HTTP_OK:
+                if start > 0:
+                    logger.error('Query aborted at offset %d with error %d' % (start, ret_code,))
+                break
+
             jsons = json.loads(lines)
+            lines = None
             for gerrit_json in jsons:
                 gerrit = dict()
-                cls._parse_gerrit(gerrit, gerrit_json, columns)
-                gerrits.append(gerrit)
+                cls._parse_gerrit(gerrit, gerrit_json, parser)
+                count = count + 1
+                yield gerrit
+                if limit and count >= limit:
+                    return
+
+            if not jsons or not jsons[-1].get('_more_changes'):
+                break
+            if limit and count >= limit:
+                break
+            start = start + len(jsons)
 
         logger.debug('DONE')
 
-        return gerrits
+        return
 
 
     @classmethod
@@ -399,97 +1123,136 @@ class GerritRESTClient():
 
         gerrit = dict()
 
+        options = ''.join(['&o=%s' % option for option in cls.get_query_options(server, columns)])
+        ret_code, lines = cls.get(server, 'changes/%s/detail' % gerrit_id,
+                                  params = options.lstrip('&'))
+        if ret_code == HTTP_OK:
+            cls._parse_gerrit(gerrit, json.loads(lines), cls.compile_columns(columns))
+        else:
+            logger.error('Failed to get gerrit %s with error %d' % (gerrit_id, ret_code,))
+
         logger.debug('DONE')
 
         return gerrit
 
 
     @classmethod
-    def _parse_gerrit(cls, gerrit, jsons, columns):
+    def gerrits(cls, server, gerrit_ids, columns, workers = DEFAULT_DETAIL_WORKERS):
+
+        # One request per change, sharing the pooled session
+        return pool_map(lambda gerrit_id: cls.gerrit(server, gerrit_id, columns),
+                        gerrit_ids, workers)
 
-        current_patch_set_id = jsons['current_revision']
-        current_patch_set = jsons['revisions'][current_patch_set_id]
-        lines_inserted = 0
-        lines_deleted = 0
-        for filename in current_patch_set['files']:
-            if current_patch_set['files'][filename].has_key('lines_inserted'):
-                lines_inserted = lines_inserted + current_patch_set['files'][filename]['lines_inserted']
-            if current_patch_set['files'][filename].has_key('lines_deleted'):
-                lines_deleted = lines_deleted + current_patch_set['files'][filename]['lines_deleted']
+
+    @classmethod
+    def compile_columns(cls, columns):
+
+        return compile_columns(columns, REST_COLUMN_EXTRACTORS)
+
+
+    @classmethod
+    def get_query_options(cls, server, columns):
+
+        options = []
+
+        major_version, minor_version = get_server_version_number(server)
+        legacy_size = major_version == 2 and minor_version < 10
 
         for col in columns:
-            if col == 'ID':
-                gerrit[col] = jsons["_number"]
-            elif col == 'Subject':
-                gerrit[col] = jsons['subject']
-            elif col == 'Owner':
-                gerrit[col] = jsons['owner']['name']
-            elif col == 'Author':
-                gerrit[col] = current_patch_set['commit']['author']['name']
-            elif col == 'Committer':
-                gerrit[col] = current_patch_set['commit']['committer']['name']
-            elif col == 'Status':
-                gerrit[col] = jsons['status']
-            elif col == 'Project':
-                gerrit[col] = jsons['project']
-            elif col == 'Branch':
-                gerrit[col] = jsons['branch']
-            elif col == 'Created-On':
-                gerrit[col] = jsons['created']
-            elif col == 'Updated-On':
-                gerrit[col] = jsons['updated']
-            elif col == 'Topic' and jsons.has_key('topic'):
-                gerrit[col] = jsons['topic']
-            elif col == 'Insertions':
-                gerrit[col] = lines_inserted
-            elif col == 'Deletions':
-                gerrit[col] = lines_deleted
+            if REST_COLUMN_OPTIONS.has_key(col):
+                col_options = REST_COLUMN_OPTIONS[col]
+            elif col == 'Insertions' or col == 'Deletions':
+                if legacy_size:
+                    col_options = REST_LEGACY_SIZE_OPTIONS
+                else:
+                    col_options = ()
+            elif REST_COLUMN_EXTRACTORS.has_key(col):
+                col_options = ()
             else:
-                labels = jsons['labels']
-                for label in labels:
-                    if label == col:
-                        for key in jsons['labels'][label]:
-                            if key != 'value' and key != 'optional':
-                                gerrit[col] = key
+                col_options = ('LABELS',)
+            for option in col_options:
+                if option not in options:
+                    options.append(option)
+
+        return options
+
+
+    @classmethod
+    def _parse_labels(cls, jsons):
+
+        labels = dict()
+
+        if jsons.has_key('labels'):
+            for label, info in jsons['labels'].iteritems():
+                for key in info:
+                    if key != 'value' and key != 'optional':
+                        labels[label] = key
+
+        return labels
+
+
+    @classmethod
+    def _parse_gerrit(cls, gerrit, jsons, parser):
+
+        extractors, has_labels = parser
+
+        if has_labels:
+            labels = cls._parse_labels(jsons)
+        else:
+            labels = None
+
+        for col, extract in extractors:
+            value = extract(jsons, labels)
+            if value is not None:
+                gerrit[col] = value
 
         return
 
 
     @classmethod
-    def get(cls, server, endpoint, params = None):
+    def get(cls, server, endpoint, params = None, headers = None,
+            response_headers = None):
 
         endpoint = endpoint.lstrip('/')
         logger.debug('REQUEST: endpoint = %s' % endpoint)
 
-        if server.has_key('AuthType'):
-            if server['AuthType'] == AUTH_TYPE_HTTP_BASIC:
-                endpoint = GERRIT_AUTH_PREFIX + endpoint
-                auth = HTTPBasicAuth(server['Username'], server['Password'])
-                cookies = None
-            elif server['AuthType'] == AUTH_TYPE_HTTP_DIGEST:
-                endpoint = GERRIT_AUTH_PREFIX + endpoint
-                auth = HTTPDigestAuth(server['Username'], server['Password'])
-                cookies = None
-            elif server['AuthType'] == AUTH_TYPE_HTTP_COOKIE:
-                endpoint = GERRIT_AUTH_PREFIX + endpoint
-                auth = None
-                cookies = RequestsCookieJar()
-                cookies.set(server['Username'], server['Password'],
-                            domain = server['URL'], path = '/')
-        else:
-            auth = None
-            cookies = None
-
-        headers = {'Content-Type': 'application/json'}
-        if server.has_key('Proxy'):
-            proxies = {'http': server['Proxy'], 'https': server['Proxy']}
-        else:
-            proxies = None
+        if server.get('AuthType', AUTH_TYPE_NONE) != AUTH_TYPE_NONE:
+            endpoint = GERRIT_AUTH_PREFIX + endpoint
 
         cmd = 'https://%s:%s/%s' % (server['URL'], server['Port'], endpoint,)
 
-        return http_get(cmd, headers = headers, proxies = proxies,
-                        auth = auth, cookies = cookies, params = params)
+        return http_get(cmd, headers = headers, params = params,
+                        session = http_sessions.get(server),
+                        response_headers = response_headers)
+
+
+    @classmethod
+    def get_cached(cls, server, endpoint):
+
+        item = server_cache.get(server, endpoint, stale = True)
+        if item and time.time() - item['Time'] <= server_cache.ttl:
+            logger.debug('CACHED: endpoint = %s' % endpoint)
+            return HTTP_OK, item['Value']
+
+        # Revalidate an expired entry instead of downloading it again
+        headers = dict()
+        if item and item.has_key('ETag'):
+            headers['If-None-Match'] = item['ETag']
+        if item and item.has_key('LastModified'):
+            headers['If-Modified-Since'] = item['LastModified']
+
+        response_headers = requests.structures.CaseInsensitiveDict()
+        ret_code, res_str = cls.get(server, endpoint, headers = headers,
+                                    response_headers = response_headers)
+        if ret_code == HTTP_NOT_MODIFIED and item:
+            server_cache.touch(server, endpoint)
+            return HTTP_OK, item['Value']
+        if ret_code == HTTP_OK:
+            server_cache.set(server, endpoint, res_str,
+                             etag = response_headers.get('ETag'),
+                             last_modified = response_headers.get('Last-Modified'))
+
+        return ret_code, res_str
 
 
 class GerritClient():
@@ -544,21 +1307,129 @@ class GerritClient():
         return ret_code, res_str
 
 
+    @classmethod
+    def probe_servers(cls, servers, workers = DEFAULT_PROBE_WORKERS):
+
+        # Servers are probed concurrently, results are in the order of servers
+        return pool_map(cls.probe_server, servers, workers)
+
+
+    @classmethod
+    def probe_server(cls, server):
+
+        try:
+            ret_code, res_str = cls.get_server_version(server)
+            if ret_code != 0:
+                return ret_code, res_str
+            ret_code, labels_str = cls.get_server_labels(server)
+        except Exception as e:
+            logger.error('Failed to probe server %s: %s' % (server['URL'], e,))
+            return 255, str(e)
+
+        return ret_code, res_str + labels_str
+
+
     @classmethod
     def query(cls, server, query, columns):
 
-        gerrits = []
+        return list(cls.iter_query(server, query, columns))
+
+
+    @classmethod
+    def iter_query(cls, server, query, columns, since = None, changes = None):
+
+        limit = get_query_limit(query)
+
+        if since is not None:
+            query = query + [get_updated_since_filter(server, since)]
+        if changes:
+            query = query + [get_changes_filter(changes)]
 
         if server['Type'] == SRV_TYPE_SSH:
-            query_str = ' '.join(query)
-            gerrits = GerritSSHClient.query(server, query_str, columns)
+            # The first limit of an SSH query wins, so the user limit would
+            # replace the page size, it is enforced by the client instead
+            query_str = ' '.join([term for term in query if not term.startswith('limit:')])
+            for gerrit in GerritSSHClient.iter_query(server, query_str, columns,
+                                                     limit = limit):
+                yield gerrit
         elif server['Type'] == SRV_TYPE_REST:
             query_str = '+'.join(query)
-            gerrits = GerritRESTClient.query(server, query_str, columns)
+            for gerrit in GerritRESTClient.iter_query(server, query_str, columns,
+                                                      limit = limit):
+                yield gerrit
         else:
             logger.error('Un-supported server type %d' % server['Type'])
 
-        return gerrits
+        return
+
+
+    @classmethod
+    def iter_federated_query(cls, servers, query, columns, stats = None,
+                             workers = DEFAULT_FEDERATION_WORKERS, since = None):
+
+        server_columns = [col for col in columns if col != FEDERATED_SERVER_COLUMN]
+        queue = Queue.Queue(maxsize = FEDERATION_QUEUE_ROWS)
+        cancel = threading.Event()
+
+        def run(server):
+            return cls.run_federated_query(server, query, server_columns, queue,
+                                           cancel, since)
+
+        # Every server is queried by its own worker and rows are passed on as
+        # the pages of any server arrive, so the total time follows the slowest
+        # one and no server result is held as a whole
+        pool = multiprocessing_pool.ThreadPool(max(1, min(workers, len(servers))))
+        pool.map_async(run, servers)
+        remaining = len(servers)
+        try:
+            while remaining > 0:
+                try:
+                    event, data = queue.get(timeout = EVENT_READ_TIMEOUT)
+                except Queue.Empty:
+                    continue
+                if event == FEDERATED_EVENT_ROW:
+                    yield data
+                else:
+                    remaining = remaining - 1
+                    if stats is not None:
+                        stats.append(data)
+        finally:
+            # Workers of a closed iterator stop at their next row
+            cancel.set()
+            pool.close()
+
+        return
+
+
+    @classmethod
+    def run_federated_query(cls, server, query, columns, queue, cancel, since = None):
+
+        count = 0
+        error = None
+        start = time.time()
+
+        gerrits = cls.iter_query(server, query, columns, since = since)
+        try:
+            for gerrit in gerrits:
+                gerrit[FEDERATED_SERVER_COLUMN] = server['Name']
+                if not put_unless_cancelled(queue, (FEDERATED_EVENT_ROW, gerrit), cancel):
+                    break
+                count = count + 1
+        except Exception as e:
+            logger.error('Federated query on %s failed: %s' % (server['Name'], e,))
+            error = str(e)
+        finally:
+            gerrits.close()
+
+        elapsed = time.time() - start
+        logger.debug('Federated query on %s: %d gerrits in %.3fs' %
+                     (server['Name'], count, elapsed,))
+
+        stats = {'Server':server['Name'], 'Count':count,
+                 'Time':elapsed, 'Error':error}
+        put_unless_cancelled(queue, (FEDERATED_EVENT_DONE, stats), cancel)
+
+        return stats
 
 
     @classmethod
@@ -576,37 +1447,216 @@ class GerritClient():
         return gerrit
 
 
+    @classmethod
+    def gerrits(cls, server, gerrit_ids, columns, workers = DEFAULT_DETAIL_WORKERS):
+
+        gerrits = []
+
+        if not gerrit_ids:
+            return gerrits
+
+        if server['Type'] == SRV_TYPE_SSH:
+            gerrits = GerritSSHClient.gerrits(server, gerrit_ids, columns, workers = workers)
+        elif server['Type'] == SRV_TYPE_REST:
+            gerrits = GerritRESTClient.gerrits(server, gerrit_ids, columns, workers = workers)
+        else:
+            logger.error('Un-supported server type %d' % server['Type'])
+
+        return gerrits
+
+
+def put_unless_cancelled(queue, item, cancel):
+
+    while not cancel.is_set():
+        try:
+            queue.put(item, timeout = EVENT_READ_TIMEOUT)
+            return True
+        except Queue.Full:
+            pass
+
+    return False
+
+
+def pool_map(func, items, workers):
+
+    # Results are in the order of items
+    pool = multiprocessing_pool.ThreadPool(max(1, min(workers, len(items))))
+    try:
+        results = pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def get_config_mirror_dir(server):
+
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', server['URL'])
+
+    return os.path.join(CONFIG_MIRROR_DIR, '%s.git' % name)
+
+
+def get_config_mirror_lock(mirror_dir):
+
+    with config_mirror_locks_lock:
+        if not config_mirror_locks.has_key(mirror_dir):
+            config_mirror_locks[mirror_dir] = threading.Lock()
+
+    return config_mirror_locks[mirror_dir]
+
+
+def get_server_version_number(server):
+
+    # Assume an up-to-date server when the version is not configured
+    if server.get('Version'):
+        versions = server['Version'].split('.')
+    else:
+        versions = LATEST_GERRIT_VERSION.split('.')
+
+    return int(versions[0]), int(versions[1])
+
+
+def parse_updated_on(server, updated_on):
+
+    # SSH timestamps are formatted in local time, REST ones are in UTC
+    timestamp = time.strptime(str(updated_on)[:19], '%Y-%m-%d %H:%M:%S')
+    if server['Type'] == SRV_TYPE_REST:
+        return calendar.timegm(timestamp)
+
+    return time.mktime(timestamp)
+
+
+def get_updated_since_filter(server, since):
+
+    since = since - QUERY_REFRESH_OVERLAP
+    major_version, minor_version = get_server_version_number(server)
+
+    # after: is only available since 2.9, older servers get a relative age
+    if major_version == 2 and minor_version < 9:
+        return '-age:%ds' % max(1, int(time.time() - since))
+
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(since))
+    if server['Type'] == SRV_TYPE_REST:
+        return 'after:{%s %%2B0000}' % timestamp
+
+    return 'after:{%s +0000}' % timestamp
+
+
+def get_changes_filter(changes):
+
+    return '(%s)' % ' OR '.join(['change:%s' % change for change in changes])
+
+
+def get_query_limit(query):
+
+    limit = None
+
+    for term in query:
+        if term.startswith('limit:'):
+            try:
+                limit = int(term[len('limit:'):].strip('{}"'))
+            except ValueError:
+                pass
+
+    return limit
+
+
 def run_ssh_cmd(server, cmd):
 
+    return list(iter_ssh_cmd(server, cmd))
+
+
+def iter_ssh_cmd(server, cmd):
+
     logger.debug('CMD: %s' % cmd)
 
-    if server.has_key('Username'):
-        username = server['Username']
-        password = server['Password']
-    else:
-        username = None
-        password = None
+    client = ssh_pool.acquire(server)
+    stdout = None
+    try:
+        stdin, stdout, stderr = client.exec_command(cmd)
+        for line in stdout:
+            yield line.rstrip('\r\n')
+    except Exception:
+        ssh_pool.discard(server, client)
+        client = None
+        raise
+    finally:
+        if stdout:
+            stdout.channel.close()
+        if client:
+            ssh_pool.release(server, client)
+
+    return
+
+
+def iter_ssh_stream(server, cmd, timeout = EVENT_READ_TIMEOUT):
+
+    logger.debug('CMD: %s' % cmd)
+
+    client = ssh_pool.acquire(server)
+    channel = None
+    try:
+        # The stream shares the pooled transport on a channel of its own
+        channel = client.get_transport().open_session()
+        channel.settimeout(timeout)
+        channel.exec_command(cmd)
+        data = ''
+        while True:
+            try:
+                chunk = channel.recv(EVENT_READ_SIZE)
+            except socket.timeout:
+                yield None
+                continue
+            if not chunk:
+                break
+            lines = (data + chunk).split('\n')
+            data = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield line.rstrip('\r')
+        if channel.exit_status_ready() and channel.recv_exit_status() != 0:
+            raise GerritSSHClientException(channel.recv_stderr(EVENT_READ_SIZE).strip())
+    except Exception:
+        ssh_pool.discard(server, client)
+        client = None
+        raise
+    finally:
+        if channel:
+            channel.close()
+        if client:
+            ssh_pool.release(server, client)
+
+    return
 
-    client = SSHClient()
-    client.load_system_host_keys()
-    client.connect(hostname = server['URL'], port = int(server['Port']),
-                   username = username, password = password)
-    stdin, stdout, stderr = client.exec_command(cmd)
 
-    return stdout.read().splitlines()
+def disable_insecure_request_warnings():
 
+    urllib3 = requests.packages.urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-def http_get(cmd, headers = None, proxies = None, auth = None, cookies = None, params = None):
+    return
+
+
+def http_get(cmd, headers = None, proxies = None, auth = None, cookies = None,
+             params = None, session = None, response_headers = None):
 
     logger.debug('REQUEST: %s' % cmd)
 
-    res = requests.get(cmd, headers = headers, proxies = proxies, auth = auth,
-                       cookies = cookies, params = params, verify = False)
+    if session:
+        res = session.get(cmd, headers = headers, proxies = proxies, auth = auth,
+                          cookies = cookies, params = params, verify = False)
+    else:
+        disable_insecure_request_warnings()
+        res = requests.get(cmd, headers = headers, proxies = proxies, auth = auth,
+                           cookies = cookies, params = params, verify = False)
 
     logger.debug('RESPONSE: url = %s, status = %d' % (res.url, res.status_code,))
 
     ret_code = res.status_code
     res_str = (res.content.lstrip(GERRIT_REST_HDR)).strip()
+    if response_headers is not None:
+        response_headers.update(res.headers)
 
     return ret_code, res_str
 
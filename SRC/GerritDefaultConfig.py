@@ -22,27 +22,78 @@ if sys.platform == 'win32':
     TMP_DIR = os.path.join(env_dict['TMP'], 'GerritKit')
     MAIN_GEOMETRY = '800x600'
     SERVER_LIST_GEOMETRY = '350x350'
-    PREFERENCES_GEOMETRY = '500x250'
+    PREFERENCES_GEOMETRY = '500x520'
     SERVER_PROFILE_GEOMETRY = '700x500'
-    QUERY_PROFILE_GEOMETRY = '800x750'
+    QUERY_PROFILE_GEOMETRY = '800x840'
 else:
     ROOT_DIR = os.path.join(env_dict['HOME'], '.GerritKit')
     TMP_DIR = '/tmp/GerritKit'
     MAIN_GEOMETRY = '800x600'
     SERVER_LIST_GEOMETRY = '350x300'
-    PREFERENCES_GEOMETRY = '500x250'
+    PREFERENCES_GEOMETRY = '500x520'
     SERVER_PROFILE_GEOMETRY = '700x500'
-    QUERY_PROFILE_GEOMETRY = '800x700'
+    QUERY_PROFILE_GEOMETRY = '800x790'
 
 CONFIG_DIR = os.path.join(ROOT_DIR, 'config')
 CONFIG_XML = os.path.join(CONFIG_DIR, 'config.xml')
 
 DEFAULT_QUERY_DIR = os.path.join(ROOT_DIR, 'query')
 
+CACHE_DIR = os.path.join(ROOT_DIR, 'cache')
+SERVER_CACHE_FILE = os.path.join(CACHE_DIR, 'servers.json')
+DEFAULT_SERVER_CACHE_TTL = 24 * 3600
+
+STORE_DIR = os.path.join(ROOT_DIR, 'store')
+DEFAULT_STORE_FILE = os.path.join(STORE_DIR, 'changes.db')
+DEFAULT_STORE_ENABLE = 0
+DEFAULT_STORE_SYNC_INTERVAL = 300
+STORE_BATCH_ROWS = 200
+
+CONFIG_MIRROR_DIR = os.path.join(ROOT_DIR, 'mirror')
+DEFAULT_KEEP_CONFIG_MIRROR = 0
+CONFIG_MIRROR_LOCK_TIMEOUT = 120
+DEFAULT_PROBE_WORKERS = 4
+DEFAULT_FEDERATION_WORKERS = 8
+FEDERATION_QUEUE_ROWS = 1000
+DEFAULT_DETAIL_WORKERS = 4
+DETAIL_BATCH_SIZE = 50
+DEFAULT_ASYNC_WORKERS = 16
+DEFAULT_ASYNC_SERVER_LIMIT = 4
+DEFAULT_BATCH_WORKERS = 4
+
 DEFAULT_LOG_DIR = os.path.join(ROOT_DIR, 'log')
 DEFAULT_LOG_FILE = 'gerrit.log'
 DEFAULT_MAX_LOG_SIZE = 2 * 1024 * 1024
 DEFAULT_LOG_BACKUP_COUNT = 3
+DEFAULT_LOG_ASYNC = 0
+DEFAULT_LOG_QUEUE_SIZE = 10000
+DEFAULT_LOG_OVERFLOW = 'drop'
+
+DEFAULT_SSH_POOL_SIZE = 8
+DEFAULT_SSH_IDLE_TIMEOUT = 300
+DEFAULT_SSH_KEEPALIVE_INTERVAL = 30
+
+DEFAULT_HTTP_POOL_CONNECTIONS = 4
+DEFAULT_HTTP_POOL_MAXSIZE = 8
+
+DEFAULT_QUERY_PAGE_SIZE = 500
+QUERY_POLL_INTERVAL = 50
+QUERY_BATCH_ROWS = 200
+QUERY_REFRESH_INTERVAL = 0.25
+QUERY_ROW_HEIGHT = 20
+QUERY_REFRESH_OVERLAP = 60
+EXPORT_FLUSH_INTERVAL = 1
+EXPORT_GZIP_LEVEL = 6
+EXPORT_PARQUET_ROW_GROUP = 10000
+DEFAULT_EXPORT_FORMAT = '.csv'
+EXPORT_PROGRESS_INTERVAL = 200
+
+EVENT_READ_TIMEOUT = 1
+EVENT_READ_SIZE = 32768
+EVENT_COALESCE_INTERVAL = 2
+EVENT_RECONNECT_MIN = 1
+EVENT_RECONNECT_MAX = 60
+EVENT_POLL_INTERVAL = 500
 
 default_servers_config = [
     {'Name':'Gerrit (SSH)',     'URL':'gerrit-review.googlesource.com',   'Port':'29418', 'Type':'1', 'Version':'3.1'},
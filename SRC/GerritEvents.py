@@ -0,0 +1,223 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+#
+# Copyright: (c) 2020, Lissy Lau <lissy.lau@gmail.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+#
+# GerritEvents
+#
+# This module provides classes for gerrit stream events
+#
+
+__version__ = '0.1'
+__author__ = 'Lissy Lau <lissy.lau@gmail.com>'
+
+import sys
+import time
+import threading
+import logging
+import collections
+
+from GerritDefaultConfig import *
+from GerritClient import *
+
+reload(sys)
+sys.setdefaultencoding('utf-8')
+logger = logging.getLogger('GerritLogger')
+
+class GerritEventSubscriber():
+
+    def __init__(self, server, interval = EVENT_COALESCE_INTERVAL):
+
+        self.server = server
+        self.interval = interval
+        self.listeners = dict()
+        self.lock = threading.Lock()
+        self.stop_event = None
+        self.thread = None
+
+        return
+
+
+    def add_listener(self, key, callback):
+
+        with self.lock:
+            self.listeners[key] = callback
+
+        return
+
+
+    def remove_listener(self, key):
+
+        with self.lock:
+            self.listeners.pop(key, None)
+            count = len(self.listeners)
+
+        return count
+
+
+    def has_listener(self, key):
+
+        with self.lock:
+            return self.listeners.has_key(key)
+
+
+    def start(self):
+
+        if self.thread:
+            return
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target = self.monitor,
+                                       args = (self.stop_event,))
+        self.thread.daemon = True
+        self.thread.start()
+
+        return
+
+
+    def stop(self):
+
+        if not self.thread:
+            return
+
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+        return
+
+
+    def monitor(self, stop_event):
+
+        backoff = EVENT_RECONNECT_MIN
+
+        while not stop_event.is_set():
+            start = time.time()
+            try:
+                self.dispatch(stop_event)
+            except Exception as e:
+                logger.error('Event stream of %s failed: %s' % (self.server['URL'], e,))
+            if stop_event.is_set():
+                break
+            # A connection which stayed up for a while starts over with a short delay
+            if time.time() - start > EVENT_RECONNECT_MAX:
+                backoff = EVENT_RECONNECT_MIN
+            logger.debug('Reconnect event stream of %s in %ds' %
+                         (self.server['URL'], backoff,))
+            stop_event.wait(backoff)
+            backoff = min(backoff * 2, EVENT_RECONNECT_MAX)
+
+        return
+
+
+    def dispatch(self, stop_event):
+
+        # Bursts are coalesced into one notification per interval with the
+        # latest event of every change
+        pending = collections.OrderedDict()
+        first = None
+
+        events = GerritSSHClient.iter_events(self.server)
+        try:
+            for event in events:
+                if stop_event.is_set():
+                    break
+                if event is not None and event.has_key('change'):
+                    number = str(event['change']['number'])
+                    pending.pop(number, None)
+                    pending[number] = event
+                    if first is None:
+                        first = time.time()
+                if pending and time.time() - first >= self.interval:
+                    self.notify(pending.values())
+                    pending = collections.OrderedDict()
+                    first = None
+        finally:
+            events.close()
+            if pending:
+                self.notify(pending.values())
+
+        return
+
+
+    def notify(self, events):
+
+        with self.lock:
+            callbacks = self.listeners.values()
+
+        logger.debug('%d events from %s' % (len(events), self.server['URL'],))
+
+        for callback in callbacks:
+            try:
+                callback(events)
+            except Exception as e:
+                logger.error('Failed to deliver events: %s' % e)
+
+        return
+
+
+class GerritEventHub():
+
+    def __init__(self):
+
+        self.subscribers = dict()
+        self.lock = threading.Lock()
+
+        return
+
+
+    def subscribe(self, server, key, callback):
+
+        # One stream per server is shared by all of its listeners
+        server_key = ssh_pool.get_key(server)
+
+        with self.lock:
+            subscriber = self.subscribers.get(server_key)
+            if not subscriber:
+                subscriber = GerritEventSubscriber(server)
+                self.subscribers[server_key] = subscriber
+            subscriber.add_listener(key, callback)
+            subscriber.start()
+
+        return
+
+
+    def unsubscribe(self, key):
+
+        stale = []
+
+        with self.lock:
+            for server_key in self.subscribers.keys():
+                subscriber = self.subscribers[server_key]
+                if subscriber.has_listener(key) and subscriber.remove_listener(key) == 0:
+                    stale.append(self.subscribers.pop(server_key))
+
+        for subscriber in stale:
+            subscriber.stop()
+
+        return
+
+
+    def close_all(self):
+
+        with self.lock:
+            stale = self.subscribers.values()
+            self.subscribers = dict()
+
+        for subscriber in stale:
+            subscriber.stop()
+
+        return
+
+
+def format_event(event):
+
+    change = event['change']
+
+    return '[%s] %s %s/%s: %s' % (event['type'], change['number'], change['project'],
+                                  change['branch'], change.get('subject', ''))
+
+
+event_hub = GerritEventHub()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+#
+# Copyright: (c) 2020, Lissy Lau <lissy.lau@gmail.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+#
+# GerritExport
+#
+# This module provides exporters for gerrit query results
+#
+
+__version__ = '0.1'
+__author__ = 'Lissy Lau <lissy.lau@gmail.com>'
+
+import sys
+import json
+import logging
+import csv
+import codecs
+import gzip
+import collections
+
+from GerritDefaultConfig import *
+from GerritUtil import LazyModule
+
+reload(sys)
+sys.setdefaultencoding('utf-8')
+logger = logging.getLogger('GerritLogger')
+
+pyarrow = LazyModule('pyarrow')
+pyarrow_parquet = LazyModule('pyarrow.parquet')
+
+EXPORT_INTEGER_COLUMNS = ('ID', 'Insertions', 'Deletions')
+
+class GerritExportException(Exception):
+    pass
+
+
+class GerritExporter():
+
+    def __init__(self, file_name, columns):
+
+        self.file_name = file_name
+        self.columns = list(columns)
+        self.integers = [col in EXPORT_INTEGER_COLUMNS for col in self.columns]
+        self.count = 0
+
+        return
+
+
+    def write_gerrit(self, gerrit):
+
+        values = []
+        for col in self.columns:
+            values.append(gerrit.get(col))
+        self.write(values)
+
+        return
+
+
+    def get_typed_values(self, values):
+
+        # Missing values are None whatever the source, the result view keeps
+        # them as empty strings and old SSH servers report numbers as strings
+        typed = []
+        for i in range(0, len(self.columns)):
+            value = values[i]
+            if value is None or value == '':
+                typed.append(None)
+            elif self.integers[i]:
+                try:
+                    typed.append(int(value))
+                except (TypeError, ValueError):
+                    typed.append(None)
+            else:
+                typed.append(value)
+
+        return typed
+
+
+    def write(self, values):
+
+        self.count = self.count + 1
+
+        return
+
+
+    def flush(self):
+
+        return
+
+
+    def close(self):
+
+        return
+
+
+class CSVExporter(GerritExporter):
+
+    def __init__(self, file_name, columns, compress = False):
+
+        GerritExporter.__init__(self, file_name, columns)
+
+        # The BOM lets spreadsheets pick up UTF-8, compressed files are for tools
+        if compress:
+            self.f = gzip.open(file_name, 'wb', EXPORT_GZIP_LEVEL)
+        else:
+            self.f = open(file_name, 'wb')
+            self.f.write(codecs.BOM_UTF8)
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(self.columns)
+
+        return
+
+
+    def write(self, values):
+
+        self.writer.writerow(values)
+        GerritExporter.write(self, values)
+
+        return
+
+
+    def flush(self):
+
+        self.f.flush()
+
+        return
+
+
+    def close(self):
+
+        self.f.close()
+
+        return
+
+
+class JSONLinesExporter(GerritExporter):
+
+    def __init__(self, file_name, columns, compress = False):
+
+        GerritExporter.__init__(self, file_name, columns)
+
+        if compress:
+            self.f = gzip.open(file_name, 'wb', EXPORT_GZIP_LEVEL)
+        else:
+            self.f = open(file_name, 'wb')
+
+        return
+
+
+    def write(self, values):
+
+        # Keys keep the column order of the result view
+        row = collections.OrderedDict(zip(self.columns, self.get_typed_values(values)))
+        line = json.dumps(row, ensure_ascii = False)
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        self.f.write(line + '\n')
+        GerritExporter.write(self, values)
+
+        return
+
+
+    def flush(self):
+
+        self.f.flush()
+
+        return
+
+
+    def close(self):
+
+        self.f.close()
+
+        return
+
+
+class ParquetExporter(GerritExporter):
+
+    def __init__(self, file_name, columns):
+
+        GerritExporter.__init__(self, file_name, columns)
+
+        try:
+            self.types = []
+            for i in range(0, len(self.columns)):
+                if self.integers[i]:
+                    self.types.append(pyarrow.int64())
+                else:
+                    self.types.append(pyarrow.string())
+            self.schema = pyarrow.schema([pyarrow.field(self.columns[i], self.types[i])
+                                          for i in range(0, len(self.columns))])
+            self.writer = pyarrow_parquet.ParquetWriter(file_name, self.schema,
+                                                        compression = 'snappy')
+        except ImportError:
+            raise GerritExportException('pyarrow is required to export %s' % file_name)
+
+        # Rows are buffered per column and written out one row group at a time
+        self.buffer = [[] for col in self.columns]
+
+        return
+
+
+    def write(self, values):
+
+        typed = self.get_typed_values(values)
+        for i in range(0, len(self.columns)):
+            value = typed[i]
+            if value is None or self.integers[i]:
+                self.buffer[i].append(value)
+            else:
+                self.buffer[i].append(unicode(value))
+        GerritExporter.write(self, values)
+        if len(self.buffer[0]) >= EXPORT_PARQUET_ROW_GROUP:
+            self._write_row_group()
+
+        return
+
+
+    def close(self):
+
+        if self.buffer and self.buffer[0]:
+            self._write_row_group()
+        self.writer.close()
+
+        return
+
+
+    def _write_row_group(self):
+
+        arrays = [pyarrow.array(self.buffer[i], type = self.types[i])
+                  for i in range(0, len(self.columns))]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema = self.schema))
+        self.buffer = [[] for col in self.columns]
+
+        return
+
+
+EXPORT_FORMATS = [
+    ('.csv',      'CSV',               lambda f, c: CSVExporter(f, c)),
+    ('.csv.gz',   'gzip CSV',          lambda f, c: CSVExporter(f, c, compress = True)),
+    ('.jsonl',    'JSON Lines',        lambda f, c: JSONLinesExporter(f, c)),
+    ('.jsonl.gz', 'gzip JSON Lines',   lambda f, c: JSONLinesExporter(f, c, compress = True)),
+    ('.parquet',  'Parquet',           lambda f, c: ParquetExporter(f, c))
+]
+
+def get_export_extensions():
+
+    return [fmt[0] for fmt in EXPORT_FORMATS]
+
+
+def get_exporter(file_name, columns):
+
+    # The longest matching extension wins so .csv.gz is not taken for .gz,
+    # unknown extensions keep the CSV format
+    match = None
+    for fmt in EXPORT_FORMATS:
+        if file_name.lower().endswith(fmt[0]):
+            if not match or len(fmt[0]) > len(match[0]):
+                match = fmt
+    if not match:
+        match = EXPORT_FORMATS[0]
+
+    logger.debug('Export %s as %s' % (file_name, match[1],))
+
+    try:
+        return match[2](file_name, columns)
+    except IOError as e:
+        raise GerritExportException('Failed to open %s: %s' % (file_name, e,))
@@ -16,26 +16,32 @@ __author__ = 'Lissy Lau <lissy.lau@gmail.com>'
 import os
 import getpass
 import sys
+import time
+import threading
 import argparse
 import logging
+import Queue
 from logging.handlers import RotatingFileHandler
-import csv
-import codecs
 import xml.dom.minidom as DOM
-import Tkinter as tk
-import ttk as ttk
-import tkMessageBox
-from FileDialog import *
 
 from GerritServer import *
 from GerritClient import *
 from GerritQuery import *
+from GerritStore import *
+from GerritEvents import *
+from GerritExport import *
 from GerritUtil import *
 from GerritDefaultConfig import *
 
 reload(sys)
 sys.setdefaultencoding('utf-8')
 
+# GUI modules are loaded on first use only, console runs never import Tk
+tk = LazyModule('Tkinter')
+ttk = LazyModule('ttk')
+tkMessageBox = LazyModule('tkMessageBox')
+FileDialog = LazyModule('FileDialog')
+
 class GerritConfigurationException(Exception):
     pass
 
@@ -48,6 +54,8 @@ class App():
         self.master.geometry(MAIN_GEOMETRY)
         self.config_xml = config_xml
         self.current_file_index = 0
+        self.probe_queue = None
+        self.query_layouts = dict()
 
         self.read_configuration_file()
 
@@ -65,13 +73,44 @@ class App():
         self.log_rotation = tk.IntVar()
         self.log_backup_count = tk.StringVar()
         self.log_max_size = tk.StringVar()
+        self.log_async = tk.IntVar()
+        self.log_queue_size = tk.StringVar()
+        self.log_overflow = tk.StringVar()
+
+        self.store_enable = tk.IntVar()
+        self.store_file = tk.StringVar()
+        self.store_sync_interval = tk.StringVar()
+
+        self.ssh_pool_size = tk.StringVar()
+        self.http_pool_connections = tk.StringVar()
+        self.http_pool_maxsize = tk.StringVar()
+
+        self.load_preferences()
+
+        return
+
 
-        logging_node = self.config_xml.getElementsByTagName('Logging')[0]
-        self.log_path.set(logging_node.getAttribute('Path'))
-        self.log_file.set(logging_node.getAttribute('FileName'))
-        self.log_rotation.set(int(logging_node.getAttribute('Rotation')))
-        self.log_backup_count.set(logging_node.getAttribute('BackupCount'))
-        self.log_max_size.set(logging_node.getAttribute('MaxSize'))
+    def load_preferences(self):
+
+        logging_config = get_logging_configuration(self.config_xml)
+        self.log_path.set(logging_config['Path'])
+        self.log_file.set(logging_config['FileName'])
+        self.log_rotation.set(logging_config['Rotation'])
+        self.log_backup_count.set(str(logging_config['BackupCount']))
+        self.log_max_size.set(str(logging_config['MaxSize']))
+        self.log_async.set(logging_config['Async'])
+        self.log_queue_size.set(str(logging_config['QueueSize']))
+        self.log_overflow.set(logging_config['Overflow'])
+
+        store_config = get_store_configuration(self.config_xml)
+        self.store_enable.set(store_config['Enable'])
+        self.store_file.set(store_config['Path'])
+        self.store_sync_interval.set(str(store_config['SyncInterval']))
+
+        connection_config = get_connection_configuration(self.config_xml)
+        self.ssh_pool_size.set(str(connection_config['SSHPoolSize']))
+        self.http_pool_connections.set(str(connection_config['HTTPPoolConnections']))
+        self.http_pool_maxsize.set(str(connection_config['HTTPPoolMaxSize']))
 
         return
 
@@ -134,6 +173,7 @@ class App():
 
         self.tab_control.add(tab, text = query_layout.query.name)
         self.tab_control.select(tab)
+        self.query_layouts[str(tab)] = query_layout
 
         return
 
@@ -142,9 +182,15 @@ class App():
 
         try:
             index = event.widget.index('@%d,%d' % (event.x, event.y))
+            tab = event.widget.tabs()[index]
             event.widget.forget(index)
         except:
-            pass
+            return
+
+        if self.query_layouts.has_key(tab):
+            self.query_layouts.pop(tab).close_query()
+        store_sync.remove(tab)
+        event_hub.unsubscribe(tab)
 
         return
 
@@ -181,7 +227,7 @@ class App():
 
     def import_configuration_file(self):
 
-        fd = LoadFileDialog(self.master)
+        fd = FileDialog.LoadFileDialog(self.master)
         input_file = fd.go()
         if input_file:
             try:
@@ -189,13 +235,18 @@ class App():
                 self.read_configuration_file()
             except:
                 logger.debug('Failed to parse configuration file %s' % input_file)
+                return
+            # Preferences missing in the imported file get their defaults
+            self.load_preferences()
+            apply_store_configuration(get_store_configuration(self.config_xml))
+            apply_connection_configuration(get_connection_configuration(self.config_xml))
 
         return
 
 
     def export_configuration_file(self):
 
-        fd = SaveFileDialog(self.master)
+        fd = FileDialog.SaveFileDialog(self.master)
         output_file = fd.go()
         if output_file:
             save_configuration_file(self.config_xml, output_file)
@@ -251,6 +302,10 @@ class App():
                                   command = self.delete_server_config)
         button_delete.pack(anchor = tk.W, side = tk.LEFT, padx = 5)
 
+        button_test = tk.Button(frm_buttons, text = 'Test All', height = 1,
+                                command = self.test_all_servers)
+        button_test.pack(anchor = tk.W, side = tk.LEFT, padx = 5)
+
         button_cancel = tk.Button(frm_buttons, text = 'Cancel', height = 1,
                                   command = self.top_config_server.destroy)
         button_cancel.pack(anchor = tk.W, side = tk.LEFT, padx = 5)
@@ -260,6 +315,58 @@ class App():
         return
 
 
+    def test_all_servers(self):
+
+        if self.probe_queue:
+            return
+
+        # Copies are probed so that the configuration is not changed by a test
+        servers = [dict(self.servers[i]) for i in range(0, len(self.servers))]
+        for server in servers:
+            server_cache.invalidate(server)
+            server['Version'] = ''
+
+        self.probe_queue = Queue.Queue()
+        worker = threading.Thread(target = run_probe_worker,
+                                  args = (servers, self.probe_queue))
+        worker.daemon = True
+        worker.start()
+
+        self.lb_server_list.delete(0, tk.END)
+        for server in servers:
+            self.lb_server_list.insert(tk.END, '%s - testing ...' % server['Name'])
+        self.top_config_server.after(QUERY_POLL_INTERVAL, self.poll_probe_servers)
+
+        return
+
+
+    def poll_probe_servers(self):
+
+        try:
+            servers, results = self.probe_queue.get_nowait()
+        except Queue.Empty:
+            self.top_config_server.after(QUERY_POLL_INTERVAL, self.poll_probe_servers)
+            return
+
+        self.probe_queue = None
+
+        try:
+            self.lb_server_list.delete(0, tk.END)
+            for i in range(0, len(servers)):
+                ret_code, res_str = results[i]
+                if ret_code == 0:
+                    status = 'OK, version %s, %d labels' % (servers[i]['Version'],
+                                                             len(servers[i].get('Labels', [])),)
+                else:
+                    status = 'failed with error %d' % ret_code
+                self.lb_server_list.insert(tk.END, '%s - %s' % (servers[i]['Name'], status,))
+        except tk.TclError:
+            # The server management window is closed
+            pass
+
+        return
+
+
     def add_server_config(self):
 
         self.top_new_server = tk.Toplevel(self.top_config_server)
@@ -356,9 +463,96 @@ class App():
 
         self.toggle_log_rotation()
 
+        chkbox_log_async = tk.Checkbutton(frm_logging, text = 'Asynchronous',
+                                          variable = self.log_async,
+                                          command = self.toggle_log_async)
+        chkbox_log_async.grid(row = 4, column = 0, columnspan = 2,
+                              sticky = tk.W, padx = 5, pady = 2)
+
+        self.label_log_queue_size = tk.Label(frm_logging, text = 'Queue Size:')
+        self.label_log_queue_size.grid(row = 5, column = 1, sticky = tk.W,
+                                       padx = 5, pady = 2)
+        self.entry_log_queue_size = tk.Entry(frm_logging, show = None, width = 10,
+                                             textvariable = self.log_queue_size)
+        self.entry_log_queue_size.grid(row = 5, column = 2, sticky = tk.W,
+                                       padx = 5, pady = 2)
+
+        self.label_log_overflow = tk.Label(frm_logging, text = 'When Full:')
+        self.label_log_overflow.grid(row = 5, column = 3, sticky = tk.W,
+                                     padx = 5, pady = 2)
+        self.combo_log_overflow = ttk.Combobox(frm_logging, width = 7,
+                                               textvariable = self.log_overflow)
+        self.combo_log_overflow['values'] = (LOG_OVERFLOW_DROP, LOG_OVERFLOW_BLOCK)
+        self.combo_log_overflow.grid(row = 5, column = 4, sticky = tk.W,
+                                     padx = 5, pady = 2)
+
+        self.toggle_log_async()
+
         frm_logging.pack(anchor = tk.W, side = tk.TOP, fill = tk.X,
                          padx = 10, pady = 5)
 
+        frm_store = tk.LabelFrame(self.top_config_preferences, text = 'Local Store',
+                                  borderwidth = 2, relief = tk.GROOVE,
+                                  padx = 5, pady = 5)
+
+        chkbox_store_enable = tk.Checkbutton(frm_store, text = 'Enable',
+                                             variable = self.store_enable,
+                                             command = self.toggle_store)
+        chkbox_store_enable.grid(row = 0, column = 0, sticky = tk.W,
+                                 padx = 5, pady = 2)
+
+        self.label_store_file = tk.Label(frm_store, text = 'File:')
+        self.label_store_file.grid(row = 1, column = 0, sticky = tk.W,
+                                   padx = 5, pady = 2)
+        self.entry_store_file = tk.Entry(frm_store, show = None, width = 50,
+                                         textvariable = self.store_file)
+        self.entry_store_file.grid(row = 1, column = 1, columnspan = 4,
+                                   sticky = tk.W, padx = 5, pady = 2)
+
+        self.label_store_sync_interval = tk.Label(frm_store, text = 'Sync Interval:')
+        self.label_store_sync_interval.grid(row = 2, column = 0, sticky = tk.W,
+                                            padx = 5, pady = 2)
+        self.entry_store_sync_interval = tk.Entry(frm_store, show = None, width = 10,
+                                                  textvariable = self.store_sync_interval)
+        self.entry_store_sync_interval.grid(row = 2, column = 1, sticky = tk.W,
+                                            padx = 5, pady = 2)
+
+        self.toggle_store()
+
+        frm_store.pack(anchor = tk.W, side = tk.TOP, fill = tk.X,
+                       padx = 10, pady = 5)
+
+        frm_connection = tk.LabelFrame(self.top_config_preferences, text = 'Connections',
+                                       borderwidth = 2, relief = tk.GROOVE,
+                                       padx = 5, pady = 5)
+
+        label_ssh_pool_size = tk.Label(frm_connection, text = 'SSH Pool Size:')
+        label_ssh_pool_size.grid(row = 0, column = 0, sticky = tk.W,
+                                 padx = 5, pady = 2)
+        entry_ssh_pool_size = tk.Entry(frm_connection, show = None, width = 10,
+                                       textvariable = self.ssh_pool_size)
+        entry_ssh_pool_size.grid(row = 0, column = 1, sticky = tk.W,
+                                 padx = 5, pady = 2)
+
+        label_http_pool_connections = tk.Label(frm_connection, text = 'HTTP Pools:')
+        label_http_pool_connections.grid(row = 1, column = 0, sticky = tk.W,
+                                         padx = 5, pady = 2)
+        entry_http_pool_connections = tk.Entry(frm_connection, show = None, width = 10,
+                                               textvariable = self.http_pool_connections)
+        entry_http_pool_connections.grid(row = 1, column = 1, sticky = tk.W,
+                                         padx = 5, pady = 2)
+
+        label_http_pool_maxsize = tk.Label(frm_connection, text = 'HTTP Pool Size:')
+        label_http_pool_maxsize.grid(row = 1, column = 2, sticky = tk.W,
+                                     padx = 5, pady = 2)
+        entry_http_pool_maxsize = tk.Entry(frm_connection, show = None, width = 10,
+                                           textvariable = self.http_pool_maxsize)
+        entry_http_pool_maxsize.grid(row = 1, column = 3, sticky = tk.W,
+                                     padx = 5, pady = 2)
+
+        frm_connection.pack(anchor = tk.W, side = tk.TOP, fill = tk.X,
+                            padx = 10, pady = 5)
+
         frm_buttons = tk.Frame(self.top_config_preferences)
 
         button_save = tk.Button(frm_buttons, text = 'Save', height = 1,
@@ -390,14 +584,63 @@ class App():
         return
 
 
+    def toggle_log_async(self):
+
+        if self.log_async.get() == 1:
+            self.label_log_queue_size.config(state = tk.NORMAL)
+            self.entry_log_queue_size.config(state = tk.NORMAL)
+            self.label_log_overflow.config(state = tk.NORMAL)
+            self.combo_log_overflow.config(state = tk.NORMAL)
+        else:
+            self.label_log_queue_size.config(state = tk.DISABLED)
+            self.entry_log_queue_size.config(state = tk.DISABLED)
+            self.label_log_overflow.config(state = tk.DISABLED)
+            self.combo_log_overflow.config(state = tk.DISABLED)
+
+        return
+
+
+    def toggle_store(self):
+
+        if self.store_enable.get() == 1:
+            self.label_store_file.config(state = tk.NORMAL)
+            self.entry_store_file.config(state = tk.NORMAL)
+            self.label_store_sync_interval.config(state = tk.NORMAL)
+            self.entry_store_sync_interval.config(state = tk.NORMAL)
+        else:
+            self.label_store_file.config(state = tk.DISABLED)
+            self.entry_store_file.config(state = tk.DISABLED)
+            self.label_store_sync_interval.config(state = tk.DISABLED)
+            self.entry_store_sync_interval.config(state = tk.DISABLED)
+
+        return
+
+
     def save_preferences(self):
 
-        logging_node = self.config_xml.getElementsByTagName('Logging')[0]
+        logging_node = get_logging_node(self.config_xml)
         logging_node.setAttribute('Path', self.log_path.get())
         logging_node.setAttribute('FileName', self.log_file.get())
         logging_node.setAttribute('Rotation', str(self.log_rotation.get()))
         logging_node.setAttribute('BackupCount', self.log_backup_count.get())
         logging_node.setAttribute('MaxSize', self.log_max_size.get())
+        logging_node.setAttribute('Async', str(self.log_async.get()))
+        logging_node.setAttribute('QueueSize', self.log_queue_size.get())
+        logging_node.setAttribute('Overflow', self.log_overflow.get())
+
+        store_node = get_store_node(self.config_xml)
+        store_node.setAttribute('Enable', str(self.store_enable.get()))
+        store_node.setAttribute('Path', self.store_file.get())
+        store_node.setAttribute('SyncInterval', self.store_sync_interval.get())
+
+        connection_node = get_connection_node(self.config_xml)
+        connection_node.setAttribute('SSHPoolSize', self.ssh_pool_size.get())
+        connection_node.setAttribute('HTTPPoolConnections', self.http_pool_connections.get())
+        connection_node.setAttribute('HTTPPoolMaxSize', self.http_pool_maxsize.get())
+
+        # The store can be switched on and off without a restart
+        apply_store_configuration(get_store_configuration(self.config_xml))
+        apply_connection_configuration(get_connection_configuration(self.config_xml))
 
         self.top_config_preferences.destroy()
 
@@ -412,7 +655,7 @@ class App():
 
     def open_query(self):
 
-        fd = LoadFileDialog(self.master)
+        fd = FileDialog.LoadFileDialog(self.master)
         query_file = fd.go(DEFAULT_QUERY_DIR)
         if query_file:
             self.add_query_tab(query_file)
@@ -422,18 +665,27 @@ class App():
 
 class ConsoleApp():
 
-    def __init__(self, args):
+    def __init__(self, args, config_xml = None):
+
+        if args.batch:
+            self._run_batch(args, config_xml)
+            return
 
         self._init_configuration(args)
 
         logger.info('Getting gerrits...')
         gerrits = self._run_query()
 
+        # Rows go out as the pages arrive, the result is never held as a whole
         if args.out_file:
             logger.info('Saving query result to %s' % args.out_file)
-            self._save_result(args.out_file, gerrits)
+            count = self._save_result(args.out_file, gerrits)
         else:
-            print gerrits
+            count = self._print_result(gerrits)
+        logger.info('%d gerrits are received' % count)
+
+        if args.follow:
+            self._follow()
 
         return
 
@@ -454,6 +706,8 @@ class ConsoleApp():
                     self.server['Port'] = DEFAULT_SSH_PORT
                 if self.server['Type'] == SRV_TYPE_REST:
                     self.server['Port'] = DEFAULT_HTTPS_PORT
+            if args.server_version:
+                self.server['Version'] = args.server_version
             if args.username:
                 self.server['Username'] = args.username
                 self.server['Password'] = ''
@@ -487,27 +741,177 @@ class ConsoleApp():
 
     def _run_query(self):
 
-        return GerritClient.query(self.server, self.query, self.columns)
+        return GerritClient.iter_query(self.server, self.query, self.columns)
 
 
-    def _save_result(self, file_name, gerrits):
+    def _follow(self):
+
+        if self.server['Type'] != SRV_TYPE_SSH:
+            raise GerritConfigurationException('--follow needs an SSH server')
+
+        events = Queue.Queue()
+        event_hub.subscribe(self.server, 'console', events.put)
+        logger.info('Following events, press Ctrl+C to stop...')
+
+        # Waiting with a timeout keeps Ctrl+C working
+        try:
+            while True:
+                try:
+                    batch = events.get(timeout = EVENT_READ_TIMEOUT)
+                except Queue.Empty:
+                    continue
+                changes = []
+                for event in batch:
+                    print format_event(event)
+                    changes.append(str(event['change']['number']))
+                for gerrit in GerritClient.iter_query(self.server, self.query,
+                                                      self.columns, changes = changes):
+                    print gerrit
+        except KeyboardInterrupt:
+            pass
+        finally:
+            event_hub.unsubscribe('console')
+
+        return
 
-        with open(file_name, 'wb') as f:
-            f.write(codecs.BOM_UTF8)
-            writer = csv.writer(f)
-            writer.writerow(self.columns)
-            for gerrit in gerrits:
-                values = []
-                for col in self.columns:
-                    if gerrit.has_key(col):
-                        values.append(gerrit[col])
-                    else:
-                        values.append('')
-                writer.writerow(values)
+
+    def _run_batch(self, args, config_xml):
+
+        servers = GerritServer(None, config_xml)
+        query_files = get_query_files(args.batch)
+        if not query_files:
+            raise GerritConfigurationException('No query file is found in %s' %
+                                               ', '.join(args.batch))
+
+        out_dir = args.out_dir or os.getcwd()
+        try:
+            os.makedirs(out_dir)
+        except OSError:
+            pass
+
+        # Queries with the same file name in different directories get a suffix
+        jobs = []
+        out_names = []
+        for query_file in query_files:
+            out_name = os.path.splitext(os.path.basename(query_file))[0]
+            if out_name in out_names:
+                out_name = '%s-%d' % (out_name, len(out_names) + 1)
+            out_names.append(out_name)
+            jobs.append((query_file, os.path.join(out_dir, out_name + args.out_format)))
+
+        logger.info('Running %d queries with %d workers...' % (len(jobs), args.workers,))
+
+        start = time.time()
+        results = pool_map(lambda job: self._run_query_file(servers, job[0], job[1]),
+                           jobs, args.workers)
+        self._print_summary(results, time.time() - start)
+
+        return
+
+
+    def _run_query_file(self, servers, query_file, out_file):
+
+        result = {'Name':os.path.basename(query_file), 'Server':'', 'Count':0,
+                  'Time':0, 'Error':None}
+        start = time.time()
+
+        try:
+            query = GerritQuery('', servers, query_file)
+            result['Name'] = query.name
+            result['Server'] = ', '.join([server['Name'] for server in query.get_servers()])
+            result['Count'] = self._save_result(out_file, query.iter_run(),
+                                                query.get_columns())
+            logger.info('Query %s is saved to %s' % (query.name, out_file,))
+        except Exception as e:
+            logger.error('Query %s failed: %s' % (query_file, e,))
+            result['Error'] = str(e)
+
+        result['Time'] = time.time() - start
+
+        return result
+
+
+    def _print_summary(self, results, elapsed):
+
+        succeeded = 0
+        gerrits = 0
+        query_time = 0
+
+        print '%-30s %-30s %8s %8s  %s' % ('Query', 'Server', 'Gerrits', 'Time(s)', 'Result')
+        for result in results:
+            if result['Error']:
+                status = 'FAILED: %s' % result['Error']
+            else:
+                status = 'OK'
+                succeeded = succeeded + 1
+            gerrits = gerrits + result['Count']
+            query_time = query_time + result['Time']
+            print '%-30s %-30s %8d %8.2f  %s' % (result['Name'][:30], result['Server'][:30],
+                                                 result['Count'], result['Time'], status)
+        print 'Total: %d/%d queries succeeded, %d gerrits in %.2fs (%.2fs of query time)' % (
+              succeeded, len(results), gerrits, elapsed, query_time)
 
         return
 
 
+    def _print_result(self, gerrits):
+
+        count = 0
+
+        for gerrit in gerrits:
+            print gerrit
+            count = count + 1
+            sys.stdout.flush()
+
+        return count
+
+
+    def _save_result(self, file_name, gerrits, columns = None):
+
+        if columns is None:
+            columns = self.columns
+
+        flush_time = 0
+
+        # The format follows the extension of the file name
+        exporter = get_exporter(file_name, columns)
+        try:
+            for gerrit in gerrits:
+                exporter.write_gerrit(gerrit)
+                # Readers of the file see the first rows without waiting for the end
+                if time.time() - flush_time >= EXPORT_FLUSH_INTERVAL:
+                    exporter.flush()
+                    flush_time = time.time()
+        finally:
+            exporter.close()
+
+        return exporter.count
+
+
+def run_probe_worker(servers, queue):
+
+    queue.put((servers, GerritClient.probe_servers(servers)))
+
+    return
+
+
+def get_query_files(paths):
+
+    query_files = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            files = [os.path.join(path, file_name) for file_name in sorted(os.listdir(path))
+                     if file_name.lower().endswith('.xml')]
+        else:
+            files = [path]
+        for query_file in files:
+            if os.path.abspath(query_file) not in [os.path.abspath(f) for f in query_files]:
+                query_files.append(query_file)
+
+    return query_files
+
+
 def create_default_configuration_file():
 
     logger.debug('Generate configuration file')
@@ -558,8 +962,23 @@ def create_default_configuration_file():
     logging_node.setAttribute('Rotation', '1')
     logging_node.setAttribute('MaxSize', str(DEFAULT_MAX_LOG_SIZE))
     logging_node.setAttribute('BackupCount', str(DEFAULT_LOG_BACKUP_COUNT))
+    logging_node.setAttribute('Async', str(DEFAULT_LOG_ASYNC))
+    logging_node.setAttribute('QueueSize', str(DEFAULT_LOG_QUEUE_SIZE))
+    logging_node.setAttribute('Overflow', DEFAULT_LOG_OVERFLOW)
     node.appendChild(logging_node)
 
+    store_node = config_xml.createElement('Store')
+    store_node.setAttribute('Enable', str(DEFAULT_STORE_ENABLE))
+    store_node.setAttribute('Path', DEFAULT_STORE_FILE)
+    store_node.setAttribute('SyncInterval', str(DEFAULT_STORE_SYNC_INTERVAL))
+    node.appendChild(store_node)
+
+    connection_node = config_xml.createElement('Connection')
+    connection_node.setAttribute('SSHPoolSize', str(DEFAULT_SSH_POOL_SIZE))
+    connection_node.setAttribute('HTTPPoolConnections', str(DEFAULT_HTTP_POOL_CONNECTIONS))
+    connection_node.setAttribute('HTTPPoolMaxSize', str(DEFAULT_HTTP_POOL_MAXSIZE))
+    node.appendChild(connection_node)
+
     return config_xml
 
 
@@ -567,6 +986,21 @@ def get_logging_configuration(config_xml):
 
     logging_config = dict()
 
+    logging_node = get_logging_node(config_xml)
+    logging_config['Path'] = logging_node.getAttribute('Path')
+    logging_config['FileName'] = logging_node.getAttribute('FileName')
+    logging_config['Rotation'] = int(logging_node.getAttribute('Rotation'))
+    logging_config['MaxSize'] = int(logging_node.getAttribute('MaxSize'))
+    logging_config['BackupCount'] = int(logging_node.getAttribute('BackupCount'))
+    logging_config['Async'] = int(logging_node.getAttribute('Async'))
+    logging_config['QueueSize'] = int(logging_node.getAttribute('QueueSize'))
+    logging_config['Overflow'] = logging_node.getAttribute('Overflow')
+
+    return logging_config
+
+
+def get_logging_node(config_xml):
+
     node = config_xml.getElementsByTagName('Configuration')
     if len(node) > 0:
         root_node = node[0]
@@ -593,6 +1027,12 @@ def get_logging_configuration(config_xml):
             logging_node.setAttribute('MaxSize', str(DEFAULT_MAX_LOG_SIZE))
         if not logging_node.hasAttribute('BackupCount'):
             logging_node.setAttribute('BackupCount', str(DEFAULT_LOG_BACKUP_COUNT))
+        if not logging_node.hasAttribute('Async'):
+            logging_node.setAttribute('Async', str(DEFAULT_LOG_ASYNC))
+        if not logging_node.hasAttribute('QueueSize'):
+            logging_node.setAttribute('QueueSize', str(DEFAULT_LOG_QUEUE_SIZE))
+        if not logging_node.hasAttribute('Overflow'):
+            logging_node.setAttribute('Overflow', DEFAULT_LOG_OVERFLOW)
     else:
         logging_node = config_xml.createElement('Logging')
         logging_node.setAttribute('Path', DEFAULT_LOG_DIR)
@@ -600,15 +1040,130 @@ def get_logging_configuration(config_xml):
         logging_node.setAttribute('Rotation', '1')
         logging_node.setAttribute('MaxSize', str(DEFAULT_MAX_LOG_SIZE))
         logging_node.setAttribute('BackupCount', str(DEFAULT_LOG_BACKUP_COUNT))
+        logging_node.setAttribute('Async', str(DEFAULT_LOG_ASYNC))
+        logging_node.setAttribute('QueueSize', str(DEFAULT_LOG_QUEUE_SIZE))
+        logging_node.setAttribute('Overflow', DEFAULT_LOG_OVERFLOW)
         preferences_node.appendChild(logging_node)
 
-    logging_config['Path'] = logging_node.getAttribute('Path')
-    logging_config['FileName'] = logging_node.getAttribute('FileName')
-    logging_config['Rotation'] = int(logging_node.getAttribute('Rotation'))
-    logging_config['MaxSize'] = int(logging_node.getAttribute('MaxSize'))
-    logging_config['BackupCount'] = int(logging_node.getAttribute('BackupCount'))
-		
-    return logging_config
+    return logging_node
+
+
+def get_store_configuration(config_xml):
+
+    store_config = dict()
+
+    store_node = get_store_node(config_xml)
+    store_config['Enable'] = int(store_node.getAttribute('Enable'))
+    store_config['Path'] = store_node.getAttribute('Path')
+    store_config['SyncInterval'] = int(store_node.getAttribute('SyncInterval'))
+
+    return store_config
+
+
+def get_store_node(config_xml):
+
+    node = config_xml.getElementsByTagName('Configuration')
+    if len(node) > 0:
+        root_node = node[0]
+    else:
+        root_node = config_xml.createElement('Configuration')
+
+    node = root_node.getElementsByTagName('Preferences')
+    if len(node) > 0:
+        preferences_node = node[0]
+    else:
+        preferences_node = config_xml.createElement('Preferences')
+        root_node.appendChild(preferences_node)
+
+    node = preferences_node.getElementsByTagName('Store')
+    if len(node) > 0:
+        store_node = node[0]
+        if not store_node.hasAttribute('Enable'):
+            store_node.setAttribute('Enable', str(DEFAULT_STORE_ENABLE))
+        if not store_node.hasAttribute('Path'):
+            store_node.setAttribute('Path', DEFAULT_STORE_FILE)
+        if not store_node.hasAttribute('SyncInterval'):
+            store_node.setAttribute('SyncInterval', str(DEFAULT_STORE_SYNC_INTERVAL))
+    else:
+        store_node = config_xml.createElement('Store')
+        store_node.setAttribute('Enable', str(DEFAULT_STORE_ENABLE))
+        store_node.setAttribute('Path', DEFAULT_STORE_FILE)
+        store_node.setAttribute('SyncInterval', str(DEFAULT_STORE_SYNC_INTERVAL))
+        preferences_node.appendChild(store_node)
+
+    return store_node
+
+
+def get_connection_configuration(config_xml):
+
+    connection_config = dict()
+
+    # Sizes which are not valid numbers fall back to the defaults
+    connection_node = get_connection_node(config_xml)
+    for name, default in (('SSHPoolSize', DEFAULT_SSH_POOL_SIZE),
+                          ('HTTPPoolConnections', DEFAULT_HTTP_POOL_CONNECTIONS),
+                          ('HTTPPoolMaxSize', DEFAULT_HTTP_POOL_MAXSIZE)):
+        try:
+            connection_config[name] = max(1, int(connection_node.getAttribute(name)))
+        except ValueError:
+            connection_config[name] = default
+
+    return connection_config
+
+
+def get_connection_node(config_xml):
+
+    node = config_xml.getElementsByTagName('Configuration')
+    if len(node) > 0:
+        root_node = node[0]
+    else:
+        root_node = config_xml.createElement('Configuration')
+
+    node = root_node.getElementsByTagName('Preferences')
+    if len(node) > 0:
+        preferences_node = node[0]
+    else:
+        preferences_node = config_xml.createElement('Preferences')
+        root_node.appendChild(preferences_node)
+
+    node = preferences_node.getElementsByTagName('Connection')
+    if len(node) > 0:
+        connection_node = node[0]
+        if not connection_node.hasAttribute('SSHPoolSize'):
+            connection_node.setAttribute('SSHPoolSize', str(DEFAULT_SSH_POOL_SIZE))
+        if not connection_node.hasAttribute('HTTPPoolConnections'):
+            connection_node.setAttribute('HTTPPoolConnections', str(DEFAULT_HTTP_POOL_CONNECTIONS))
+        if not connection_node.hasAttribute('HTTPPoolMaxSize'):
+            connection_node.setAttribute('HTTPPoolMaxSize', str(DEFAULT_HTTP_POOL_MAXSIZE))
+    else:
+        connection_node = config_xml.createElement('Connection')
+        connection_node.setAttribute('SSHPoolSize', str(DEFAULT_SSH_POOL_SIZE))
+        connection_node.setAttribute('HTTPPoolConnections', str(DEFAULT_HTTP_POOL_CONNECTIONS))
+        connection_node.setAttribute('HTTPPoolMaxSize', str(DEFAULT_HTTP_POOL_MAXSIZE))
+        preferences_node.appendChild(connection_node)
+
+    return connection_node
+
+
+def apply_connection_configuration(connection_config):
+
+    ssh_pool.configure(max_size = connection_config['SSHPoolSize'])
+    http_sessions.configure(pool_connections = connection_config['HTTPPoolConnections'],
+                            pool_maxsize = connection_config['HTTPPoolMaxSize'])
+
+    return
+
+
+def apply_store_configuration(store_config):
+
+    store_sync.stop()
+    change_store.configure(enable = store_config['Enable'] == 1,
+                           store_file = store_config['Path'])
+    store_sync.configure(interval = store_config['SyncInterval'])
+    if store_config['Enable'] == 1 and store_config['SyncInterval'] > 0:
+        store_sync.start()
+
+    return
 
 
 def save_configuration_file(config_xml, output_file):
@@ -637,15 +1192,17 @@ def main_gui(config_xml):
     return
 
 
-def main_console(args):
+def main_console(args, config_xml):
 
     logger.info('Session started in console mode')
 
     try:
-        app = ConsoleApp(args)
+        app = ConsoleApp(args, config_xml)
     except GerritConfigurationException as e:
         logger.error(e)
         logger.info('Run GerritKit --help for details')
+    except GerritExportException as e:
+        logger.error(e)
 
     return
 
@@ -690,6 +1247,9 @@ def main():
                         help = 'gerrit server')
     parser.add_argument('--server-port', metavar ='<PORT>',
                         dest = 'server_port', help = 'gerrit server port')
+    parser.add_argument('--server-version', metavar ='<VERSION>',
+                        dest = 'server_version',
+                        help = 'gerrit server version, e.g. 2.15 (default: %s)' % LATEST_GERRIT_VERSION)
     parser.add_argument('--username', metavar = '<USERNAME>', dest = 'username',
                         help = 'login username')
     parser.add_argument('--password', metavar = '<PASSWORD>', dest = 'password',
@@ -697,9 +1257,36 @@ def main():
     parser.add_argument('--columns', metavar = '<COL1,COL2,...>', dest = 'columns',
                         help = 'query columns')
     parser.add_argument('--output', metavar = '<FILE>', dest = 'out_file',
-                        help = 'save to <FILE>')
+                        help = 'save to <FILE>, the format follows its extension: %s' %
+                        ' | '.join(get_export_extensions()))
+    parser.add_argument('--follow', action = 'store_true', dest = 'follow',
+                        help = 'print updated gerrits from stream events (SSH only)')
+    parser.add_argument('--batch', metavar = '<PATH>', dest = 'batch', nargs = '+',
+                        help = 'run saved query files or all query files in directories')
+    parser.add_argument('--workers', metavar = '<N>', dest = 'workers', type = int,
+                        help = 'queries run concurrently in batch mode (default: %d)' % DEFAULT_BATCH_WORKERS)
+    parser.add_argument('--output-dir', metavar = '<DIR>', dest = 'out_dir',
+                        help = 'save batch results to <DIR> (default: current directory)')
+    parser.add_argument('--output-format', metavar = '<EXT>', dest = 'out_format',
+                        choices = get_export_extensions(),
+                        help = 'format of batch results (default: %s)' % DEFAULT_EXPORT_FORMAT)
     args = parser.parse_args()
 
+    # Batch mode always runs in the console, other console options are not
+    # silently dropped by the GUI
+    if args.batch:
+        args.console = True
+        if args.follow:
+            parser.error('--follow cannot be used with --batch')
+    elif args.workers is not None or args.out_dir or args.out_format:
+        parser.error('--workers, --output-dir and --output-format need --batch')
+    if args.follow and not args.console:
+        parser.error('--follow needs --console')
+    if args.workers is None:
+        args.workers = DEFAULT_BATCH_WORKERS
+    if args.out_format is None:
+        args.out_format = DEFAULT_EXPORT_FORMAT
+
     logger = logging.getLogger('GerritLogger')
     logger.setLevel(logging.DEBUG)
 
@@ -736,16 +1323,47 @@ def main():
         log_formatter = GerritLogFormatter(fmt)
     log_handler.setLevel(logging.DEBUG)
     log_handler.setFormatter(log_formatter)
-    logger.addHandler(log_handler)
+    if logging_config['Async'] == 1:
+        log_queue = Queue.Queue(maxsize = logging_config['QueueSize'])
+        log_listener = GerritQueueListener(log_queue, log_handler)
+        log_listener.start()
+        queue_handler = GerritQueueHandler(log_queue,
+                                           overflow = logging_config['Overflow'])
+        queue_handler.setLevel(logging.DEBUG)
+        logger.addHandler(queue_handler)
+    else:
+        log_listener = None
+        queue_handler = None
+        logger.addHandler(log_handler)
 
     logger.info('--- Session Start ---')
 
-    if args.console:
-        main_console(args)
-    else:
-        main_gui(config_xml)
+    # Queued log records are flushed even when the session fails, they are
+    # what explains the failure
+    try:
+        try:
+            apply_store_configuration(get_store_configuration(config_xml))
+            apply_connection_configuration(get_connection_configuration(config_xml))
 
-    logger.info('--- Session End ---')
+            if args.console:
+                main_console(args, config_xml)
+            else:
+                main_gui(config_xml)
+        finally:
+            event_hub.close_all()
+            store_sync.stop()
+            change_store.close()
+            ssh_pool.close_all()
+            http_sessions.close_all()
+
+            logger.info('--- Session End ---')
+    finally:
+        if log_listener:
+            log_listener.stop()
+            if queue_handler.dropped > 0:
+                logger.removeHandler(queue_handler)
+                logger.addHandler(log_handler)
+                logger.warning('%d log records were dropped' % queue_handler.dropped)
 
     return
 
@@ -15,27 +15,38 @@ __author__ = 'Lissy Lau <lissy.lau@gmail.com>'
 
 import os
 import sys
+import time
 import copy
-import csv
-import codecs
 import logging
+import threading
+import Queue
 import xml.dom.minidom as DOM
-import Tkinter as tk
-import ttk as ttk
-from FileDialog import *
 
 from GerritDefaultConfig import *
 from GerritServer import *
 from GerritClient import *
+from GerritStore import *
+from GerritEvents import *
+from GerritExport import *
+from GerritUtil import LazyModule
 
 reload(sys)
 sys.setdefaultencoding('utf-8')
 logger = logging.getLogger('GerritLogger')
 
+tk = LazyModule('Tkinter')
+ttk = LazyModule('ttk')
+FileDialog = LazyModule('FileDialog')
+tkFileDialog = LazyModule('tkFileDialog')
+
 FILE_TYPE_UNKNOWN = 0
 FILE_TYPE_CSV = 1
 FILE_TYPE_XML = 2
 
+QUERY_EVENT_ROW = 0
+QUERY_EVENT_DONE = 1
+QUERY_EVENT_ERROR = 2
+
 class GerritQueryException(Exception):
     pass
 
@@ -50,6 +61,8 @@ class GerritQuery():
         self.server_name = None
         self.columns_config = None
         self.query = None
+        self.federated_servers = []
+        self.federated_stats = []
 
         if query_file:
             try:
@@ -90,16 +103,23 @@ class GerritQuery():
             col['Display'] = int(column.getAttribute('Display'))
             col['Width'] = int(column.getAttribute('Width'))
             columns.append(col)
+        federated_server_names = []
+        nodes = root_node.getElementsByTagName('Federation')
+        for federation in nodes:
+            for server in federation.getElementsByTagName('Server'):
+                federated_server_names.append(server.getAttribute('Name'))
         self.configure(name = root_node.getAttribute('Name'),
                        server_name = root_node.getAttribute('Server'),
                        query = query,
                        columns_config = columns,
+                       federated_server_names = federated_server_names,
                        update_xml = False)
 
         return
 
     def configure(self, name = None, server_name = None, query = None,
-                  columns_config = None, update_xml = True):
+                  columns_config = None, federated_server_names = None,
+                  update_xml = True):
 
         root_node = self.query_xml.getElementsByTagName('Query')[0]
 
@@ -141,10 +161,35 @@ class GerritQuery():
                     column.setAttribute('Display', str(col['Display']))
                     column.setAttribute('Width', str(col['Width']))
                     column_node.appendChild(column)
+        # An empty list turns the federated query off
+        if federated_server_names is not None:
+            federated_servers = []
+            for server_name in federated_server_names:
+                index = self.servers.find(server_name)
+                if index < 0:
+                    raise GerritQueryException('Server %s is not found' % server_name)
+                federated_servers.append(self.servers[index])
+            self.federated_servers = federated_servers
+            if update_xml:
+                federation_node = root_node.getElementsByTagName('Federation')
+                if len(federation_node) > 0:
+                    root_node.removeChild(federation_node[0])
+                if len(federated_server_names) > 0:
+                    federation_node = self.query_xml.createElement('Federation')
+                    root_node.appendChild(federation_node)
+                    for server_name in federated_server_names:
+                        server = self.query_xml.createElement('Server')
+                        server.setAttribute('Name', server_name)
+                        federation_node.appendChild(server)
 
         return
 
 
+    def is_federated(self):
+
+        return len(self.federated_servers) > 0
+
+
     def get_columns(self):
 
         columns = []
@@ -155,9 +200,9 @@ class GerritQuery():
         return columns
 
 
-    def run(self):
+    def build_query(self):
 
-        if not self.server:
+        if not self.server and not self.is_federated():
             raise GerritQueryException('Server is not configured')
         if not self.query:
             raise GerritQueryException('Query filters are not configured')
@@ -179,9 +224,88 @@ class GerritQuery():
             else:
                 filter = key + ':{' + self.query[key] + '}'
                 query.append(filter)
-			
-        return GerritClient.query(self.server, query,
-                                  columns = self.get_columns())
+
+        return query
+
+
+    def run(self):
+
+        return list(self.iter_run())
+
+
+    def iter_run(self, since = None, changes = None):
+
+        # Filters are resolved here so that the returned iterator does not
+        # depend on the query configuration any more
+        query = self.build_query()
+
+        if self.is_federated():
+            self.federated_stats = []
+            gerrits = GerritClient.iter_federated_query(self.federated_servers, query,
+                                                        columns = self.get_columns(),
+                                                        stats = self.federated_stats,
+                                                        since = since)
+        else:
+            gerrits = GerritClient.iter_query(self.server, query,
+                                              columns = self.get_columns(),
+                                              since = since, changes = changes)
+
+        if change_store.enabled:
+            gerrits = change_store.iter_save(gerrits, self.get_gerrit_server)
+
+        return gerrits
+
+
+    def run_local(self):
+
+        if not change_store.enabled:
+            raise GerritQueryException('Local store is disabled')
+        if not self.query:
+            raise GerritQueryException('Query filters are not configured')
+
+        gerrits = []
+
+        for server in self.get_servers():
+            for gerrit in change_store.query(server, self.query):
+                if self.is_federated():
+                    gerrit[FEDERATED_SERVER_COLUMN] = server['Name']
+                gerrits.append(gerrit)
+
+        return gerrits
+
+
+    def get_servers(self):
+
+        if self.is_federated():
+            return self.federated_servers
+        if not self.server:
+            raise GerritQueryException('Server is not configured')
+
+        return [self.server]
+
+
+    def get_gerrit_server(self, gerrit):
+
+        if gerrit.has_key(FEDERATED_SERVER_COLUMN):
+            for server in self.federated_servers:
+                if server['Name'] == gerrit[FEDERATED_SERVER_COLUMN]:
+                    return server
+
+        return self.server
+
+
+    def get_federated_summary(self):
+
+        summary = []
+
+        for stats in self.federated_stats:
+            if stats['Error']:
+                summary.append('%s: failed in %.2fs' % (stats['Server'], stats['Time'],))
+            else:
+                summary.append('%s: %d in %.2fs' % (stats['Server'], stats['Count'],
+                                                    stats['Time'],))
+
+        return ', '.join(summary)
 
 
     def gerrit(self, gerrit_id):
@@ -191,8 +315,41 @@ class GerritQuery():
         if not self.columns_config:
             raise GerritQueryException('Query fields are not configured')
 
-        return GerritClient.gerrit(self.server, gerrit_id,
-                                   columns = self.get_columns())
+        try:
+            gerrit = GerritClient.gerrit(self.server, gerrit_id,
+                                         columns = self.get_columns())
+        except Exception as e:
+            # Fall back to the last detail kept in the store when offline
+            if not change_store.enabled:
+                raise
+            stored_gerrit = change_store.get_detail(self.server, gerrit_id)
+            if not stored_gerrit:
+                raise e
+            logger.warning('Gerrit %s is read from the store: %s' % (gerrit_id, e,))
+            return stored_gerrit
+
+        if change_store.enabled and gerrit:
+            change_store.save_detail(self.server, gerrit)
+
+        return gerrit
+
+
+    def gerrits(self, gerrit_ids):
+
+        if not self.server:
+            raise GerritQueryException('Server is not configured')
+        if not self.columns_config:
+            raise GerritQueryException('Query fields are not configured')
+
+        gerrits = GerritClient.gerrits(self.server, gerrit_ids,
+                                       columns = self.get_columns())
+
+        if change_store.enabled:
+            for gerrit in gerrits:
+                if gerrit:
+                    change_store.save_detail(self.server, gerrit)
+
+        return gerrits
 
 
     def save(self, file_name):
@@ -439,6 +596,22 @@ class QueryProfile():
         self.combo_server_name.grid(row = 0, column = 3, sticky = tk.W,
                                     pady = 2)
 
+        # Servers selected here are queried in parallel instead of Server
+        label_federation = tk.Label(frm_basic, text = 'Federated:')
+        label_federation.grid(row = 1, column = 0, sticky = tk.NW,
+                              padx = 5, pady = 2)
+        self.list_federation = tk.Listbox(frm_basic, height = 4, width = 40,
+                                          selectmode = tk.MULTIPLE,
+                                          exportselection = 0)
+        federated_names = [server['Name'] for server in self.query.federated_servers]
+        server_count = len(self.servers)
+        for i in range(0, server_count):
+            self.list_federation.insert(tk.END, self.servers[i]['Name'])
+            if self.servers[i]['Name'] in federated_names:
+                self.list_federation.selection_set(i)
+        self.list_federation.grid(row = 1, column = 1, columnspan = 3,
+                                  sticky = tk.W, padx = 5, pady = 2)
+
         frm_basic.pack(anchor = tk.W, side = tk.TOP, fill = tk.X,
                        padx = 10, pady = 5)
 
@@ -940,6 +1113,21 @@ class QueryProfile():
             col['Width'] = local_col['Width'].get()
             columns_config.append(col)
 
+        federated_server_names = []
+        for index in self.list_federation.curselection():
+            federated_server_names.append(self.list_federation.get(index))
+
+        # Federated results carry the name of the server they come from
+        server_columns = [col for col in columns_config
+                          if col['Name'] == FEDERATED_SERVER_COLUMN]
+        if len(federated_server_names) > 0:
+            if len(server_columns) == 0:
+                columns_config.insert(0, {'Name':FEDERATED_SERVER_COLUMN,
+                                          'Display':1, 'Width':100})
+        else:
+            for col in server_columns:
+                columns_config.remove(col)
+
         query = dict()
 
         if self.filter_type.get() == 0:
@@ -987,7 +1175,8 @@ class QueryProfile():
         self.query.configure(name = self.query_name.get(),
                              server_name = self.server_name.get(),
                              query = query,
-                             columns_config = columns_config)
+                             columns_config = columns_config,
+                             federated_server_names = federated_server_names)
 
         self.parent.update_query_name(self.query.name)
         self.parent.update_columns(columns_config)
@@ -1027,19 +1216,57 @@ class QueryLayout():
         self.status_msg = tk.StringVar()
         self.status_msg.set('')
 
+        self.query_queue = None
+        self.query_cancel = None
+        self.query_incremental = False
+        self.gerrit_count = 0
+        self.last_refresh = 0
+        self.export_state = None
+
+        # Latest Updated-On per server, incremental refreshes start from here
+        self.updated_on = dict()
+        self.refresh_gerrits = []
+
+        # Changes reported by stream events, applied when no query is running
+        self.live = tk.IntVar()
+        self.live.set(0)
+        self.live_queue = Queue.Queue()
+        self.live_pending = set()
+        self.live_changes = None
+        self.live_server = None
+        self.live_after = None
+
         return
 
 
     def init_layout(self):
 
         style = ttk.Style()
-        style.configure("Query.Treeview", rowheight = 20)
+        style.configure("Query.Treeview", rowheight = QUERY_ROW_HEIGHT)
 
         frm_buttons = tk.Frame(self.tab)
 
-        button_run = tk.Button(frm_buttons, text = 'Run Query',
-                               height = 1, command = self.run_query)
-        button_run.pack(anchor = tk.W, side = tk.LEFT, padx = 5)
+        self.button_run = tk.Button(frm_buttons, text = 'Run Query',
+                                    height = 1, command = self.run_query)
+        self.button_run.pack(anchor = tk.W, side = tk.LEFT, padx = 5)
+
+        self.button_refresh = tk.Button(frm_buttons, text = 'Refresh',
+                                        height = 1, command = self.refresh_query)
+        self.button_refresh.pack(anchor = tk.W, side = tk.LEFT, padx = 5)
+
+        self.button_local = tk.Button(frm_buttons, text = 'Run Local',
+                                      height = 1, command = self.run_local_query)
+        self.button_local.pack(anchor = tk.W, side = tk.LEFT, padx = 5)
+
+        self.button_cancel = tk.Button(frm_buttons, text = 'Cancel',
+                                       height = 1, state = tk.DISABLED,
+                                       command = self.cancel_query)
+        self.button_cancel.pack(anchor = tk.W, side = tk.LEFT, padx = 5)
+
+        chkbox_live = tk.Checkbutton(frm_buttons, text = 'Live',
+                                     variable = self.live,
+                                     command = self.toggle_live)
+        chkbox_live.pack(anchor = tk.W, side = tk.LEFT, padx = 5)
 
         button_configure = tk.Button(frm_buttons, text = 'Configure',
                                      height = 1, command = self.configure_query)
@@ -1049,18 +1276,16 @@ class QueryLayout():
                                 command = self.save_query)
         button_save.pack(anchor = tk.W, side = tk.LEFT, padx = 5)
 
-        button_export = tk.Button(frm_buttons, text = 'Export', height = 1,
-                                  command = self.export_query_result)
-        button_export.pack(anchor = tk.W, side = tk.LEFT, padx = 5)
+        self.button_export = tk.Button(frm_buttons, text = 'Export', height = 1,
+                                       command = self.export_query_result)
+        self.button_export.pack(anchor = tk.W, side = tk.LEFT, padx = 5)
 
         frm_buttons.pack(anchor = tk.W, side = tk.TOP, padx = 5, pady = 5)
 
         frm_result = tk.Frame(self.tab)
 
-        self.gerrit_list = ttk.Treeview(frm_result, show = "headings",
-                                        style = "Query.Treeview")
+        self.gerrit_list = QueryResultView(frm_result, style = "Query.Treeview")
         self.update_columns()
-        self.gerrit_list.pack(side = tk.LEFT, fill = tk.BOTH, expand = 1)
 
         frm_result.pack(anchor = tk.W, side = tk.TOP, fill = tk.BOTH, expand = 1)
 
@@ -1115,15 +1340,16 @@ class QueryLayout():
 
         columns = self.get_columns()
         display_columns = self.get_display_columns()
-        self.gerrit_list.config(columns = columns,
-                                displaycolumns = display_columns)
+        tree = self.gerrit_list.tree
+        tree.config(columns = columns, displaycolumns = display_columns)
         for col in self.columns_config:
-            self.gerrit_list.column(col['Name'], width = col['Width'],
-                                    anchor = 'w', stretch = True) 
-            self.gerrit_list.heading(col['Name'], text = col['Name'],
-                                     anchor = 'w')
+            tree.column(col['Name'], width = col['Width'],
+                        anchor = 'w', stretch = True) 
+            tree.heading(col['Name'], text = col['Name'], anchor = 'w')
             logger.debug('Add column: Name = %s, Width = %d' %
                          (col['Name'], col['Width'],))
+        self.updated_on = dict()
+        self.gerrit_list.refresh()
         self.tab.update()
 
         return
@@ -1131,35 +1357,376 @@ class QueryLayout():
 
     def run_query(self):
 
-        rows = self.gerrit_list.get_children()
-        for item in rows:
-            self.gerrit_list.delete(item)
+        if self.query_queue:
+            return
+
+        self.gerrit_list.clear()
+        self.updated_on = dict()
+        self.reset_progress()
+
+        try:
+            gerrits = self.query.iter_run()
+        except GerritQueryException as e:
+            self.status(e)
+            return
+
+        self.start_query(gerrits, incremental = False)
+
+        return
+
+
+    def run_local_query(self):
+
+        if self.query_queue:
+            return
+
+        start = time.time()
+
+        try:
+            gerrits = self.query.run_local()
+        except (GerritQueryException, GerritStoreException) as e:
+            self.status(e)
+            return
+
+        # Refresh continues from the stored result with the server deltas
+        self.gerrit_list.clear()
+        self.updated_on = dict()
+        self.query_incremental = False
+        self.gerrit_count = 0
+        self.add_gerrits(gerrits, self.get_columns())
+        self.init_progress(self.gerrit_count)
+        self.progress_step(self.gerrit_count)
+        self.status('Local query done, total %d gerrits in %d ms' %
+                    (self.gerrit_count, (time.time() - start) * 1000,))
+
+        return
+
+
+    def refresh_query(self):
+
+        if self.query_queue:
+            return
+
+        # Rows can only be merged into a previous result with known change IDs
+        since = self.get_updated_since()
+        if since is None or 'ID' not in self.get_columns():
+            self.run_query()
+            return
+
         self.reset_progress()
 
         try:
-            self.status('Query is running, please wait ...')
-            gerrits = self.query.run()
+            gerrits = self.query.iter_run(since = since)
         except GerritQueryException as e:
             self.status(e)
             return
-        gerrit_count = len(gerrits)
-        self.init_progress(gerrit_count)
-        self.status('Gerrit [0/%d]' % gerrit_count)
-
-        for i in range(0, gerrit_count):
-            line = []
-            self.status('Gerrit [%d/%d]: Processing Gerrit %s' %
-                        (i + 1, gerrit_count, gerrits[i]['ID']))
-            for col in self.query.get_columns():
-                if gerrits[i].has_key(col):
-                    line.append(gerrits[i][col])
+
+        self.start_query(gerrits, incremental = True)
+
+        return
+
+
+    def start_query(self, gerrits, incremental):
+
+        self.query_queue = Queue.Queue()
+        self.query_cancel = threading.Event()
+        self.query_incremental = incremental
+        self.refresh_gerrits = []
+        self.live_changes = None
+        self.gerrit_count = 0
+        self.last_refresh = time.time()
+
+        worker = threading.Thread(target = run_query_worker,
+                                  args = (gerrits, self.query_queue, self.query_cancel))
+        worker.daemon = True
+        worker.start()
+
+        self.button_run.config(state = tk.DISABLED)
+        self.button_refresh.config(state = tk.DISABLED)
+        self.button_local.config(state = tk.DISABLED)
+        self.button_cancel.config(state = tk.NORMAL)
+        self.progress.config(mode = 'indeterminate')
+        self.progress.start()
+        self.status('Query is running, please wait ...')
+        self.tab.after(QUERY_POLL_INTERVAL, self.poll_query)
+
+        return
+
+
+    def poll_query(self):
+
+        queue = self.query_queue
+        if not queue:
+            return
+
+        columns = self.get_columns()
+        gerrits = []
+
+        # Insert at most one batch per tick so that the UI stays responsive
+        while len(gerrits) < QUERY_BATCH_ROWS:
+            try:
+                event, data = queue.get_nowait()
+            except Queue.Empty:
+                break
+            if event == QUERY_EVENT_ROW:
+                gerrits.append(data)
+            elif event == QUERY_EVENT_DONE:
+                self.add_gerrits(gerrits, columns)
+                if self.query_incremental:
+                    count = self.apply_refresh(columns)
+                    message = 'Refresh done, %d gerrits updated' % count
                 else:
-                    line.append('')
-            self.gerrit_list.insert('', tk.END, values = line)
-            self.progress_step(i + 1)
-            self.tab.update()
+                    message = 'Query done, total %d gerrits' % self.gerrit_count
+                if self.query.is_federated():
+                    message = '%s (%s)' % (message, self.query.get_federated_summary())
+                self.finish_query(message)
+                return
+            elif event == QUERY_EVENT_ERROR:
+                self.add_gerrits(gerrits, columns)
+                self.finish_query('Query aborted: %s' % data, completed = False)
+                return
+
+        self.add_gerrits(gerrits, columns)
+
+        now = time.time()
+        if gerrits and now - self.last_refresh >= QUERY_REFRESH_INTERVAL:
+            self.last_refresh = now
+            self.status_msg.set('Gerrit [%d]: Query is running, please wait ...' %
+                                self.gerrit_count)
+
+        if len(gerrits) == QUERY_BATCH_ROWS:
+            self.tab.after_idle(self.poll_query)
+        else:
+            self.tab.after(QUERY_POLL_INTERVAL, self.poll_query)
+
+        return
+
+
+    def get_gerrit_line(self, gerrit, columns):
+
+        line = []
+
+        for col in columns:
+            if gerrit.has_key(col):
+                line.append(gerrit[col])
+            else:
+                line.append('')
+
+        return line
+
+
+    def add_gerrits(self, gerrits, columns):
+
+        # Refreshed rows are merged at once when the refresh is complete
+        if self.query_incremental:
+            self.gerrit_count = self.gerrit_count + len(gerrits)
+            self.refresh_gerrits.extend(gerrits)
+            return
+
+        lines = []
+        for gerrit in gerrits:
+            lines.append(self.get_gerrit_line(gerrit, columns))
+            self.update_watermark(gerrit)
+        self.add_gerrit_lines(lines)
+
+        return
+
+
+    def add_gerrit_lines(self, lines):
+
+        if lines:
+            self.gerrit_count = self.gerrit_count + len(lines)
+            self.gerrit_list.extend(lines)
+
+        return
+
+
+    def apply_refresh(self, columns):
+
+        # A live update only covers the changes named by the events, others
+        # updated meanwhile must still be found by the next refresh
+        lines = []
+        for gerrit in self.refresh_gerrits:
+            lines.append(self.get_gerrit_line(gerrit, columns))
+            if self.live_changes is None:
+                self.update_watermark(gerrit)
+        self.refresh_gerrits = []
+
+        # Changes of different servers may share the same number
+        keys = [columns.index(col) for col in (FEDERATED_SERVER_COLUMN, 'ID')
+                if col in columns]
+        key = lambda line: tuple([str(line[i]) for i in keys])
+        self.gerrit_list.upsert(lines, key)
+
+        # Changes of a live update which are not returned left the result
+        if self.live_changes:
+            self.gerrit_list.remove(self.live_changes - set([key(line) for line in lines]),
+                                    key)
+            self.live_changes = None
+
+        return len(lines)
+
+
+    def update_watermark(self, gerrit):
+
+        if not gerrit.get('Updated-On'):
+            return
+
+        server = self.query.get_gerrit_server(gerrit)
+        try:
+            updated_on = parse_updated_on(server, gerrit['Updated-On'])
+        except ValueError:
+            logger.debug('Invalid Updated-On: %s' % gerrit['Updated-On'])
+            return
+
+        if updated_on > self.updated_on.get(server['Name'], 0):
+            self.updated_on[server['Name']] = updated_on
+
+        return
+
+
+    def get_updated_since(self):
+
+        if not self.updated_on:
+            return None
+
+        # The oldest server decides so that no update is skipped on any server
+        return min(self.updated_on.values())
+
+
+    def cancel_query(self):
+
+        if not self.query_queue:
+            return
+
+        self.query_cancel.set()
+        self.finish_query('Query cancelled, %d gerrits received' % self.gerrit_count,
+                          completed = False)
 
-        self.status('Query done, total %d gerrits' % gerrit_count)
+        return
+
+
+    def close_query(self):
+
+        self.cancel_query()
+
+        if self.live_after:
+            self.tab.after_cancel(self.live_after)
+            self.live_after = None
+        self.live.set(0)
+
+        return
+
+
+    def finish_query(self, message, completed = True):
+
+        # Late results of a cancelled worker go to the dropped queue
+        self.query_queue = None
+        self.query_cancel = None
+
+        # A partial result must not move the refresh starting point
+        if not completed:
+            if self.query_incremental:
+                self.refresh_gerrits = []
+            else:
+                self.updated_on = dict()
+        elif change_store.enabled:
+            self.register_sync()
+
+        self.progress.stop()
+        self.progress.config(mode = 'determinate')
+        self.init_progress(self.gerrit_count)
+        self.progress_step(self.gerrit_count)
+        self.button_run.config(state = tk.NORMAL)
+        self.button_refresh.config(state = tk.NORMAL)
+        self.button_local.config(state = tk.NORMAL)
+        self.button_cancel.config(state = tk.DISABLED)
+        self.status(message)
+
+        return
+
+
+    def toggle_live(self):
+
+        if self.live_after:
+            self.tab.after_cancel(self.live_after)
+            self.live_after = None
+
+        if self.live.get() == 0:
+            event_hub.unsubscribe(str(self.tab))
+            self.live_pending = set()
+            self.status('Live updates are stopped')
+            return
+
+        server = self.query.server
+        if self.query.is_federated() or not server or server['Type'] != SRV_TYPE_SSH:
+            self.live.set(0)
+            self.status('Live updates need a single SSH server')
+            return
+
+        # Fetched changes are merged into the result by their number
+        if 'ID' not in self.get_columns():
+            self.live.set(0)
+            self.status('Live updates need the ID column in the query result')
+            return
+
+        self.live_server = server
+        event_hub.subscribe(server, str(self.tab), self.live_queue.put)
+        self.live_after = self.tab.after(EVENT_POLL_INTERVAL, self.poll_events)
+        self.status('Live updates from %s are started' % server['Name'])
+
+        return
+
+
+    def poll_events(self):
+
+        self.live_after = None
+
+        if self.live.get() == 0:
+            return
+
+        # Follow the query when it is re-configured to another server or
+        # without the ID column
+        if self.query.server is not self.live_server or 'ID' not in self.get_columns():
+            event_hub.unsubscribe(str(self.tab))
+            self.toggle_live()
+            return
+
+        while True:
+            try:
+                events = self.live_queue.get_nowait()
+            except Queue.Empty:
+                break
+            for event in events:
+                self.live_pending.add(str(event['change']['number']))
+
+        # Only the changes named by the events are fetched, in one query,
+        # their numbers are known so no previous result is needed
+        if self.live_pending and not self.query_queue:
+            changes = sorted(self.live_pending)
+            try:
+                gerrits = self.query.iter_run(changes = changes)
+            except GerritQueryException as e:
+                self.status(e)
+            else:
+                self.live_pending = set()
+                self.start_query(gerrits, incremental = True)
+                self.live_changes = set([(change,) for change in changes])
+
+        self.live_after = self.tab.after(EVENT_POLL_INTERVAL, self.poll_events)
+
+        return
+
+
+    def register_sync(self):
+
+        # The store keeps following this query in the background
+        try:
+            store_sync.add(str(self.tab), self.query.get_servers(),
+                           self.query.build_query(), self.get_columns(),
+                           since = self.updated_on)
+        except GerritQueryException as e:
+            logger.debug('Query is not synced: %s' % e)
 
         return
 
@@ -1209,7 +1776,7 @@ class QueryLayout():
 
     def save_query(self):
 
-        fd = SaveFileDialog(self.tab)
+        fd = FileDialog.SaveFileDialog(self.tab)
         file_name = fd.go(DEFAULT_QUERY_DIR)
         if file_name:
             self.query.save(file_name)
@@ -1220,24 +1787,332 @@ class QueryLayout():
 
     def export_query_result(self):
 
-        fd = SaveFileDialog(self.tab)
-        file_name = fd.go()
-        if file_name:
-            with open(file_name, 'w') as f:
-                f.write(codecs.BOM_UTF8)
-                writer = csv.writer(f)
-                writer.writerow(self.get_columns())
-                rows = self.gerrit_list.get_children()
-                row_count = len(rows)
-                self.init_progress(row_count)
-                self.status('Exporting to %s' % file_name)
-                for i in range(0, row_count):
-                    values = self.gerrit_list.item(rows[i], 'values')
-                    writer.writerow(values)
-                    self.progress_step(i + 1)
-                    self.tab.update()
-            self.status('Write done, total %d rows are saved in %s' %
-                        (row_count, file_name,))
+        if self.query_queue or self.export_state:
+            return
+
+        # The chosen file type is appended when the name has no known extension
+        extensions = get_export_extensions()
+        file_type = tk.StringVar(self.tab, value = DEFAULT_EXPORT_FORMAT)
+        file_name = tkFileDialog.asksaveasfilename(parent = self.tab,
+                                                   title = 'Export Query Result',
+                                                   filetypes = [(ext, '*' + ext) for ext in extensions],
+                                                   typevariable = file_type)
+        if not file_name:
+            return
+        if not [ext for ext in extensions if file_name.lower().endswith(ext)]:
+            if file_type.get() in extensions:
+                file_name = file_name + file_type.get()
+            else:
+                file_name = file_name + DEFAULT_EXPORT_FORMAT
+
+        try:
+            exporter = get_exporter(file_name, self.get_columns())
+        except GerritExportException as e:
+            self.status(e)
+            return
+
+        # The worker writes a snapshot of the row store, rows arriving later
+        # do not change the exported result
+        rows = list(self.gerrit_list.rows)
+        self.export_state = {'File':file_name, 'Total':len(rows), 'Count':0,
+                             'Done':False, 'Error':None, 'Start':time.time()}
+
+        worker = threading.Thread(target = run_export_worker,
+                                  args = (exporter, rows, self.export_state))
+        worker.daemon = True
+        worker.start()
+
+        self.button_run.config(state = tk.DISABLED)
+        self.button_refresh.config(state = tk.DISABLED)
+        self.button_local.config(state = tk.DISABLED)
+        self.button_export.config(state = tk.DISABLED)
+        self.init_progress(len(rows))
+        self.status('Exporting to %s' % file_name)
+        self.tab.after(EXPORT_PROGRESS_INTERVAL, self.poll_export)
+
+        return
+
+
+    def poll_export(self):
+
+        state = self.export_state
+        if not state:
+            return
+
+        # Progress is sampled per tick instead of being pushed per row
+        self.progress_step(state['Count'])
+        if not state['Done']:
+            self.status_msg.set('Exporting to %s [%d/%d]' %
+                                (state['File'], state['Count'], state['Total'],))
+            self.tab.after(EXPORT_PROGRESS_INTERVAL, self.poll_export)
+            return
+
+        self.export_state = None
+        self.button_run.config(state = tk.NORMAL)
+        self.button_refresh.config(state = tk.NORMAL)
+        self.button_local.config(state = tk.NORMAL)
+        self.button_export.config(state = tk.NORMAL)
+        if state['Error']:
+            self.status('Export aborted: %s' % state['Error'])
+        else:
+            self.status('Write done, total %d rows are saved in %s in %d ms' %
+                        (state['Count'], state['File'], (time.time() - state['Start']) * 1000,))
+
+        return
+
+
+class QueryResultView():
+
+    def __init__(self, parent, style):
+
+        # Only the visible window of the row store is materialized as items
+        self.rows = []
+        self.items = []
+        self.first = 0
+        self.visible = 1
+        self.selected = None
+
+        self.scrollbar = tk.Scrollbar(parent, orient = tk.VERTICAL,
+                                      command = self.yview)
+        self.scrollbar.pack(side = tk.RIGHT, fill = tk.Y)
+
+        self.tree = ttk.Treeview(parent, show = "headings", style = style,
+                                 selectmode = tk.BROWSE)
+        self.tree.pack(side = tk.LEFT, fill = tk.BOTH, expand = 1)
+
+        self.tree.bind('<Configure>', self.resize)
+        self.tree.bind('<<TreeviewSelect>>', self.select)
+        self.tree.bind('<MouseWheel>', self.scroll_wheel)
+        self.tree.bind('<Button-4>', lambda event: self.scroll(-3))
+        self.tree.bind('<Button-5>', lambda event: self.scroll(3))
+        self.tree.bind('<Up>', lambda event: self.move_selection(-1))
+        self.tree.bind('<Down>', lambda event: self.move_selection(1))
+        self.tree.bind('<Prior>', lambda event: self.move_selection(-self.visible))
+        self.tree.bind('<Next>', lambda event: self.move_selection(self.visible))
+        self.tree.bind('<Home>', lambda event: self.move_selection(-len(self.rows)))
+        self.tree.bind('<End>', lambda event: self.move_selection(len(self.rows)))
+
+        return
+
+
+    def __len__(self):
+
+        return len(self.rows)
+
+
+    def clear(self):
+
+        self.rows = []
+        self.first = 0
+        self.selected = None
+        self.refresh()
 
         return
 
+
+    def upsert(self, lines, key):
+
+        index = dict()
+        for i in range(0, len(self.rows)):
+            index[key(self.rows[i])] = i
+
+        # Known rows are updated in place, new ones are the most recent
+        new_lines = []
+        for line in lines:
+            if index.has_key(key(line)):
+                self.rows[index[key(line)]] = line
+            else:
+                new_lines.append(line)
+
+        if new_lines:
+            self.rows[0:0] = new_lines
+            if self.selected is not None:
+                self.selected = self.selected + len(new_lines)
+
+        self.refresh()
+
+        return
+
+
+    def remove(self, keys, key):
+
+        rows = [row for row in self.rows if key(row) not in keys]
+        if len(rows) == len(self.rows):
+            return
+
+        self.rows = rows
+        self.selected = None
+        self.first = max(0, min(self.first, len(self.rows) - self.visible))
+        self.refresh()
+
+        return
+
+
+    def extend(self, lines):
+
+        start = len(self.rows)
+        self.rows.extend(lines)
+
+        if start < self.first + self.visible:
+            self.refresh()
+        else:
+            self.update_scrollbar()
+
+        return
+
+
+    def refresh(self):
+
+        count = max(0, min(self.visible, len(self.rows) - self.first))
+
+        while len(self.items) > count:
+            self.tree.delete(self.items.pop())
+        while len(self.items) < count:
+            self.items.append(self.tree.insert('', tk.END))
+
+        for i in range(0, count):
+            self.tree.item(self.items[i], values = self.rows[self.first + i])
+
+        selected = self.selected
+        if selected is not None and self.first <= selected < self.first + count:
+            self.tree.selection_set(self.items[selected - self.first])
+        elif self.tree.selection():
+            self.tree.selection_remove(self.tree.selection())
+
+        self.update_scrollbar()
+
+        return
+
+
+    def update_scrollbar(self):
+
+        total = len(self.rows)
+        if total == 0:
+            self.scrollbar.set(0.0, 1.0)
+        else:
+            self.scrollbar.set(float(self.first) / total,
+                               float(min(self.first + self.visible, total)) / total)
+
+        return
+
+
+    def scroll_to(self, first):
+
+        first = min(first, len(self.rows) - self.visible)
+        first = max(first, 0)
+        if first != self.first:
+            self.first = first
+            self.refresh()
+
+        return
+
+
+    def scroll(self, rows):
+
+        self.scroll_to(self.first + rows)
+
+        return
+
+
+    def yview(self, *args):
+
+        if args[0] == tk.MOVETO:
+            self.scroll_to(int(float(args[1]) * len(self.rows)))
+        elif args[0] == tk.SCROLL:
+            if args[2] == tk.PAGES:
+                self.scroll(int(args[1]) * self.visible)
+            else:
+                self.scroll(int(args[1]))
+
+        return
+
+
+    def scroll_wheel(self, event):
+
+        if event.delta > 0:
+            self.scroll(-3)
+        else:
+            self.scroll(3)
+
+        return
+
+
+    def resize(self, event):
+
+        # Leave one row for the heading
+        visible = max(1, event.height / QUERY_ROW_HEIGHT - 1)
+        if visible != self.visible:
+            self.visible = visible
+            self.scroll_to(self.first)
+            self.refresh()
+
+        return
+
+
+    def select(self, event):
+
+        selection = self.tree.selection()
+        if selection and selection[0] in self.items:
+            self.selected = self.first + self.items.index(selection[0])
+
+        return
+
+
+    def move_selection(self, rows):
+
+        if not self.rows:
+            return 'break'
+
+        if self.selected is None:
+            selected = self.first
+        else:
+            selected = self.selected + rows
+        selected = max(0, min(selected, len(self.rows) - 1))
+        self.selected = selected
+
+        if selected < self.first:
+            self.scroll_to(selected)
+        elif selected >= self.first + self.visible:
+            self.scroll_to(selected - self.visible + 1)
+        self.refresh()
+
+        return 'break'
+
+
+def run_export_worker(exporter, rows, state):
+
+    try:
+        for row in rows:
+            exporter.write(row)
+            state['Count'] = exporter.count
+    except Exception as e:
+        logger.error('Export failed: %s' % e)
+        state['Error'] = e
+    finally:
+        try:
+            exporter.close()
+        except Exception as e:
+            logger.error('Export failed: %s' % e)
+            state['Error'] = state['Error'] or e
+        state['Done'] = True
+
+    return
+
+
+def run_query_worker(gerrits, queue, cancel):
+
+    try:
+        for gerrit in gerrits:
+            if cancel.is_set():
+                break
+            queue.put((QUERY_EVENT_ROW, gerrit))
+        queue.put((QUERY_EVENT_DONE, None))
+    except Exception as e:
+        logger.error('Query failed: %s' % e)
+        queue.put((QUERY_EVENT_ERROR, e))
+    finally:
+        # Closing the iterator releases its SSH channel early on cancel
+        if hasattr(gerrits, 'close'):
+            gerrits.close()
+
+    return
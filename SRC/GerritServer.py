@@ -18,16 +18,18 @@ import sys
 import logging
 import copy
 import xml.dom.minidom as DOM
-import Tkinter as tk
-import ttk as ttk
-import tkMessageBox
 
 from GerritClient import *
+from GerritUtil import LazyModule
 
 reload(sys)
 sys.setdefaultencoding('utf-8')
 logger = logging.getLogger('GerritLogger')
 
+tk = LazyModule('Tkinter')
+ttk = LazyModule('ttk')
+tkMessageBox = LazyModule('tkMessageBox')
+
 DEFAULT_USER = getpass.getuser()
 DEFAULT_PASSWORD = ''
 
@@ -166,6 +168,14 @@ class GerritServer():
                       self.data[index]['Type'],
                       self.data[index]['Version'],))
 
+        # Cached probes of the old address must not answer for the new one
+        old_server = self.data[index]
+        for key in ('URL', 'Port', 'Type', 'Proxy'):
+            if old_server.get(key) != server.get(key):
+                server_cache.invalidate(old_server)
+                server_cache.invalidate(server)
+                break
+
         self.index = index
         update_server = copy.deepcopy(server)
         self.data[self.index] = update_server
@@ -609,6 +619,9 @@ class ServerProfile():
         if self.server_use_proxy.get() == 1:
             server['Proxy'] = self.server_proxy.get()
 
+        # A test always probes the server again
+        server_cache.invalidate(server)
+
         if server['Version'] == '':
             self.status_msg.set('Getting server version ...')
             self.top.update()
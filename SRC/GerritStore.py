@@ -0,0 +1,463 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+#
+# Copyright: (c) 2020, Lissy Lau <lissy.lau@gmail.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+#
+# GerritStore
+#
+# This module provides classes for the local gerrit change store
+#
+
+__version__ = '0.1'
+__author__ = 'Lissy Lau <lissy.lau@gmail.com>'
+
+import json
+import os
+import re
+import sys
+import time
+import threading
+import logging
+
+from GerritDefaultConfig import *
+from GerritClient import *
+from GerritUtil import LazyModule
+
+reload(sys)
+sys.setdefaultencoding('utf-8')
+logger = logging.getLogger('GerritLogger')
+
+sqlite3 = LazyModule('sqlite3')
+
+STORE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS changes (
+    server TEXT NOT NULL,
+    id TEXT NOT NULL,
+    project TEXT,
+    branch TEXT,
+    status TEXT,
+    owner TEXT,
+    owner_username TEXT,
+    owner_email TEXT,
+    updated REAL,
+    row TEXT,
+    detail TEXT,
+    PRIMARY KEY (server, id)
+);
+'''
+
+STORE_INDEXES = '''
+CREATE INDEX IF NOT EXISTS changes_project ON changes (server, project);
+CREATE INDEX IF NOT EXISTS changes_branch ON changes (server, branch);
+CREATE INDEX IF NOT EXISTS changes_status ON changes (server, status);
+CREATE INDEX IF NOT EXISTS changes_owner ON changes (server, owner COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS changes_owner_username ON changes (server, owner_username COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS changes_owner_email ON changes (server, owner_email COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS changes_updated ON changes (server, updated);
+'''
+
+STORE_STATUS = {
+    'open':      ('NEW', 'DRAFT'),
+    'closed':    ('MERGED', 'ABANDONED'),
+    'merged':    ('MERGED',),
+    'abandoned': ('ABANDONED',),
+    'new':       ('NEW',),
+    'draft':     ('DRAFT',)
+}
+
+STORE_AGE_UNITS = (
+    ('mon', 30 * 24 * 3600),
+    ('s', 1),
+    ('m', 60),
+    ('h', 3600),
+    ('d', 24 * 3600),
+    ('w', 7 * 24 * 3600),
+    ('y', 365 * 24 * 3600)
+)
+
+class GerritStoreException(Exception):
+    pass
+
+
+class GerritChangeStore():
+
+    def __init__(self, store_file = DEFAULT_STORE_FILE):
+
+        self.store_file = store_file
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.conn = None
+
+        return
+
+
+    def configure(self, enable = None, store_file = None):
+
+        if enable is not None:
+            self.enabled = enable
+        if store_file and store_file != self.store_file:
+            self.close()
+            self.store_file = store_file
+
+        return
+
+
+    def get_key(self, server):
+
+        return '%d:%s' % (int(server['Type']), server['URL'])
+
+
+    def save(self, server, gerrits):
+
+        updated = None
+        batch = []
+
+        for gerrit in gerrits:
+            batch.append((server, gerrit))
+            if len(batch) >= STORE_BATCH_ROWS:
+                updated = max(updated, self._write(batch))
+                batch = []
+        if batch:
+            updated = max(updated, self._write(batch))
+
+        return updated
+
+
+    def iter_save(self, gerrits, get_server):
+
+        batch = []
+
+        # Rows are passed through as they come and written in batches
+        try:
+            for gerrit in gerrits:
+                batch.append((get_server(gerrit), gerrit))
+                if len(batch) >= STORE_BATCH_ROWS:
+                    self._write(batch)
+                    batch = []
+                yield gerrit
+        finally:
+            if batch:
+                self._write(batch)
+            if hasattr(gerrits, 'close'):
+                gerrits.close()
+
+        return
+
+
+    def save_detail(self, server, gerrit):
+
+        self._write([(server, gerrit)], detail = True)
+
+        return
+
+
+    def get_detail(self, server, gerrit_id):
+
+        with self.lock:
+            conn = self._connect()
+            result = conn.execute('SELECT row, detail FROM changes WHERE server = ? AND id = ?',
+                                  (self.get_key(server), str(gerrit_id))).fetchone()
+
+        if not result or not result[1]:
+            return None
+
+        return json.loads(result[1])
+
+
+    def query(self, server, query):
+
+        clauses, params, limit = self.build_filter(server, query)
+
+        where = ' AND '.join(clauses)
+        sql = 'SELECT row FROM changes WHERE %s ORDER BY updated DESC' % where
+        if limit:
+            sql = '%s LIMIT %d' % (sql, limit)
+
+        with self.lock:
+            conn = self._connect()
+            rows = conn.execute(sql, params).fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+
+    def build_filter(self, server, query):
+
+        clauses = ['server = ?']
+        params = [self.get_key(server)]
+        limit = None
+
+        for key in query.keys():
+            value = query[key]
+            if key in ('project', 'branch'):
+                clauses.append('%s = ?' % key)
+                params.append(value)
+            elif key == 'owner':
+                owner = value.strip('"{} ')
+                if owner.lower() == 'self':
+                    if not server.get('Username'):
+                        raise GerritStoreException('Owner self needs the login of server %s'
+                                                   % server['Name'])
+                    owner = server['Username']
+                # The owner may be given by name, username or email
+                clauses.append('(owner = ? COLLATE NOCASE OR owner_username = ? COLLATE NOCASE '
+                               'OR owner_email = ? COLLATE NOCASE)')
+                params.extend([owner, owner, owner])
+            elif key == 'change':
+                clauses.append('id = ?')
+                params.append(value)
+            elif key == 'status':
+                if not STORE_STATUS.has_key(value.lower()):
+                    raise GerritStoreException('Status %s is not supported by the local store' % value)
+                status = STORE_STATUS[value.lower()]
+                clauses.append('status IN (%s)' % ', '.join(['?'] * len(status)))
+                params.extend(status)
+            elif key == 'age':
+                clauses.append('updated <= ?')
+                params.append(time.time() - parse_age(value))
+            elif key == 'before':
+                clauses.append('updated <= ?')
+                params.append(parse_date(value))
+            elif key == 'after':
+                clauses.append('updated >= ?')
+                params.append(parse_date(value))
+            elif key == 'limit':
+                try:
+                    limit = int(value)
+                except ValueError:
+                    raise GerritStoreException('Invalid limit %s' % value)
+            else:
+                raise GerritStoreException('Filter %s is not supported by the local store' % key)
+
+        return clauses, params, limit
+
+
+    def close(self):
+
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+        return
+
+
+    def _connect(self):
+
+        if self.conn:
+            return self.conn
+
+        try:
+            os.makedirs(os.path.dirname(self.store_file))
+        except OSError:
+            pass
+
+        # One connection is shared by all threads, access is serialized by the lock
+        self.conn = sqlite3.connect(self.store_file, check_same_thread = False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(STORE_SCHEMA)
+        # Stores of earlier versions lack the owner account columns
+        names = [row[1] for row in self.conn.execute('PRAGMA table_info(changes)')]
+        for name in ('owner_username', 'owner_email'):
+            if name not in names:
+                self.conn.execute('ALTER TABLE changes ADD COLUMN %s TEXT' % name)
+        self.conn.executescript(STORE_INDEXES)
+        logger.debug('Store %s is opened' % self.store_file)
+
+        return self.conn
+
+
+    def _write(self, batch, detail = False):
+
+        updated = None
+
+        # The store must never break a live query
+        try:
+            with self.lock:
+                conn = self._connect()
+                for server, gerrit in batch:
+                    updated = max(updated, self._upsert(conn, server, gerrit, detail))
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error('Failed to write %d gerrits to the store: %s' % (len(batch), e,))
+
+        return updated
+
+
+    def _upsert(self, conn, server, gerrit, detail):
+
+        if not gerrit.has_key('ID'):
+            return None
+
+        key = self.get_key(server)
+        change_id = str(gerrit['ID'])
+        row = dict()
+        for col in gerrit.keys():
+            if col != FEDERATED_SERVER_COLUMN:
+                row[col] = gerrit[col]
+
+        # Columns of earlier queries are kept so that any saved query can run
+        result = conn.execute('SELECT row FROM changes WHERE server = ? AND id = ?',
+                              (key, change_id)).fetchone()
+        if result:
+            merged = json.loads(result[0])
+            merged.update(row)
+            row = merged
+
+        updated = None
+        if row.get('Updated-On'):
+            try:
+                updated = parse_updated_on(server, row['Updated-On'])
+            except ValueError:
+                pass
+
+        values = (row.get('Project'), row.get('Branch'), row.get('Status'),
+                  row.get('Owner'), row.get(OWNER_USERNAME_COLUMN),
+                  row.get(OWNER_EMAIL_COLUMN), updated, json.dumps(row))
+        if result:
+            conn.execute('UPDATE changes SET project = ?, branch = ?, status = ?, '
+                         'owner = ?, owner_username = ?, owner_email = ?, updated = ?, '
+                         'row = ? WHERE server = ? AND id = ?',
+                         values + (key, change_id))
+        else:
+            conn.execute('INSERT INTO changes (project, branch, status, owner, owner_username, '
+                         'owner_email, updated, row, server, id) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         values + (key, change_id))
+        if detail:
+            conn.execute('UPDATE changes SET detail = ? WHERE server = ? AND id = ?',
+                         (json.dumps(gerrit), key, change_id))
+
+        return updated
+
+
+class GerritStoreSync():
+
+    def __init__(self, store, interval = DEFAULT_STORE_SYNC_INTERVAL):
+
+        self.store = store
+        self.interval = interval
+        self.jobs = dict()
+        self.lock = threading.Lock()
+        self.stop_event = None
+        self.thread = None
+
+        return
+
+
+    def configure(self, interval = None):
+
+        if interval is not None:
+            self.interval = interval
+
+        return
+
+
+    def add(self, key, servers, query, columns, since = None):
+
+        job = dict()
+        job['Servers'] = servers
+        job['Query'] = query
+        job['Columns'] = [col for col in columns if col != FEDERATED_SERVER_COLUMN]
+        job['Since'] = dict(since or {})
+
+        with self.lock:
+            self.jobs[key] = job
+
+        return
+
+
+    def remove(self, key):
+
+        with self.lock:
+            self.jobs.pop(key, None)
+
+        return
+
+
+    def start(self):
+
+        if self.thread:
+            return
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target = self.monitor,
+                                       args = (self.stop_event,))
+        self.thread.daemon = True
+        self.thread.start()
+
+        return
+
+
+    def stop(self):
+
+        if not self.thread:
+            return
+
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+        return
+
+
+    def monitor(self, stop_event):
+
+        while not stop_event.wait(self.interval):
+            with self.lock:
+                jobs = self.jobs.values()
+            for job in jobs:
+                if stop_event.is_set():
+                    break
+                self.sync(job)
+
+        return
+
+
+    def sync(self, job):
+
+        # Only the changes updated since the last sync of a server are fetched
+        for server in job['Servers']:
+            since = job['Since'].get(server['Name'])
+            start = time.time()
+            try:
+                gerrits = GerritClient.iter_query(server, job['Query'], job['Columns'],
+                                                  since = since)
+                updated = self.store.save(server, gerrits)
+            except Exception as e:
+                logger.error('Failed to sync %s: %s' % (server['Name'], e,))
+                continue
+            if updated:
+                job['Since'][server['Name']] = max(updated, since)
+            logger.debug('Server %s is synced in %.3fs' % (server['Name'],
+                                                          time.time() - start,))
+
+        return
+
+
+def parse_age(age):
+
+    match = re.match(r'^\s*(\d+)\s*([a-z]+)\s*$', age.lower())
+    if match:
+        for unit, seconds in STORE_AGE_UNITS:
+            if match.group(2).startswith(unit):
+                return int(match.group(1)) * seconds
+
+    raise GerritStoreException('Invalid age %s' % age)
+
+
+def parse_date(date):
+
+    # Dates without a time zone are taken as local time
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(date.strip('"{} ')[:19], fmt))
+        except ValueError:
+            pass
+
+    raise GerritStoreException('Invalid date %s' % date)
+
+
+change_store = GerritChangeStore()
+store_sync = GerritStoreSync(change_store)
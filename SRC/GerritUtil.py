@@ -13,39 +13,230 @@
 __version__ = '0.1'
 __author__ = 'Lissy Lau <lissy.lau@gmail.com>'
 
+import os
 import sys
+import time
+import errno
 import logging
-import inspect
+import threading
+import importlib
+import Queue
 
 reload(sys)
 sys.setdefaultencoding('utf-8')
 
+LOG_OVERFLOW_DROP = 'drop'
+LOG_OVERFLOW_BLOCK = 'block'
+
+
+class LazyModule(object):
+
+    # Defers the import of a heavy module to the first attribute access, so
+    # that code paths which never use it do not pay for loading it
+    def __init__(self, name):
+
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+        return
+
+
+    def __getattr__(self, attr):
+
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+
+        return getattr(module, attr)
+
+
+def get_class_name(record):
+
+    # Walk up to the frame which issued the logging call, no source context
+    # is loaded so this is much cheaper than inspect.stack()
+    frame = sys._getframe(1)
+    while frame:
+        code = frame.f_code
+        if (frame.f_lineno == record.lineno and
+            code.co_name == record.funcName and
+            code.co_filename == record.pathname):
+            try:
+                return frame.f_locals['self'].__class__.__name__
+            except KeyError:
+                break
+        frame = frame.f_back
+
+    return 'Global'
+
+
 class GerritLogFormatter(logging.Formatter):
 
     def format(self, record):
 
-        stack = inspect.stack()
+        if not hasattr(record, 'className'):
+            record.className = get_class_name(record)
+
+        return logging.Formatter.format(self, record)
+
+
+class GerritRotatingLogFormatter(GerritLogFormatter):
+
+    pass
+
+
+class GerritQueueHandler(logging.Handler):
+
+    def __init__(self, queue, overflow = LOG_OVERFLOW_DROP):
+
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.overflow = overflow
+        self.dropped = 0
+
+        return
+
+
+    def prepare(self, record):
+
+        # Everything depending on the calling thread is resolved before the
+        # record is handed over to the listener
+        record.className = get_class_name(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+    def emit(self, record):
 
         try:
-            className = stack[9][0].f_locals['self'].__class__.__name__
-        except KeyError:
-            className = 'Global'
-        record.className = className
+            record = self.prepare(record)
+            if self.overflow == LOG_OVERFLOW_BLOCK:
+                self.queue.put(record)
+            else:
+                self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped = self.dropped + 1
+        except Exception:
+            self.handleError(record)
 
-        return super(GerritLogFormatter, self).format(record)
+        return
 
 
-class GerritRotatingLogFormatter(logging.Formatter):
+class GerritFileLock():
 
-    def format(self, record):
+    # A lock file shared by all processes. The holder touches the file while
+    # it runs, so a lock not touched within the timeout is left over by a
+    # crashed process and taken over
+    def __init__(self, lock_file, timeout, interval = 0.1):
+
+        self.lock_file = lock_file
+        self.timeout = timeout
+        self.interval = interval
+        self.stop_event = None
+        self.thread = None
+
+        return
+
+
+    def __enter__(self):
+
+        start = time.time()
+
+        while True:
+            try:
+                fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()))
+                os.close(fd)
+                self.stop_event = threading.Event()
+                self.thread = threading.Thread(target = self.refresh,
+                                               args = (self.stop_event,))
+                self.thread.daemon = True
+                self.thread.start()
+                return self
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                if time.time() - os.path.getmtime(self.lock_file) > self.timeout:
+                    os.remove(self.lock_file)
+                    continue
+            except OSError:
+                continue
+            if time.time() - start > self.timeout:
+                raise IOError('Timed out waiting for %s' % self.lock_file)
+            time.sleep(self.interval)
+
+        return self
 
-        stack = inspect.stack()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.stop_event.set()
+        self.thread.join()
 
         try:
-            className = stack[10][0].f_locals['self'].__class__.__name__
-        except KeyError:
-            className = 'Global'
-        record.className = className
+            os.remove(self.lock_file)
+        except OSError:
+            pass
+
+        return False
+
+
+    def refresh(self, stop_event):
+
+        while not stop_event.wait(self.timeout / 4.0):
+            try:
+                os.utime(self.lock_file, None)
+            except OSError:
+                pass
+
+        return
+
+
+class GerritQueueListener():
+
+    def __init__(self, queue, handler):
+
+        self.queue = queue
+        self.handler = handler
+        self.thread = None
+
+        return
+
+
+    def start(self):
+
+        self.thread = threading.Thread(target = self.monitor)
+        self.thread.daemon = True
+        self.thread.start()
+
+        return
+
+
+    def stop(self):
+
+        if self.thread:
+            # The sentinel is never dropped, wait for room in the queue
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.handler.flush()
+
+        return
+
+
+    def monitor(self):
 
-        return super(GerritRotatingLogFormatter, self).format(record)
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if record.levelno >= self.handler.level:
+                self.handler.handle(record)
 
+        return